@@ -0,0 +1,4 @@
+from dotenv import load_dotenv
+
+# the one place .env is read: every app module sees it before reading its os.getenv settings
+load_dotenv()
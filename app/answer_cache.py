@@ -0,0 +1,123 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "on").lower() not in ("0", "off", "false", "no")
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 512))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 3600))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", 0))
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+class AnswerCache:
+    def __init__(self, max_entries: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 similarity: float = ANSWER_CACHE_SIMILARITY, enabled: bool = ANSWER_CACHE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.enabled = enabled and max_entries > 0
+        self._entries: "OrderedDict[Tuple, Dict]" = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_generation(self, scope: Tuple) -> None:
+        generation = scope[0]
+        if generation != self._generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._generation = generation
+
+    def _alive(self, key: Tuple, entry: Dict, now: float) -> bool:
+        if self.ttl and now - entry["created"] > self.ttl:
+            del self._entries[key]
+            return False
+        return True
+
+    def get(self, scope: Tuple, question: str) -> Optional[Dict]:
+        if not self.enabled:
+            return None
+        key = (scope, normalize_question(question))
+        with self._lock:
+            self._check_generation(scope)
+            entry = self._entries.get(key)
+            if entry is None or not self._alive(key, entry, time.time()):
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {**entry["value"], "cached": "exact"}
+
+    def get_similar(self, scope: Tuple, qvec: np.ndarray) -> Optional[Dict]:
+        if not self.enabled or self.similarity <= 0:
+            self._miss()
+            return None
+        q = np.asarray(qvec, dtype="float32").reshape(-1)
+        now = time.time()
+        with self._lock:
+            self._check_generation(scope)
+            best_key, best_sim = None, self.similarity
+            for key, entry in list(self._entries.items()):
+                if key[0] != scope or not self._alive(key, entry, now):
+                    continue
+                sim = float(np.dot(entry["qvec"], q))
+                if sim >= best_sim:
+                    best_key, best_sim = key, sim
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            self.semantic_hits += 1
+            return {**self._entries[best_key]["value"], "cached": "semantic"}
+
+    def _miss(self) -> None:
+        if self.enabled:
+            with self._lock:
+                self.misses += 1
+
+    def put(self, scope: Tuple, question: str, qvec: np.ndarray, value: Dict) -> None:
+        if not self.enabled:
+            return
+        key = (scope, normalize_question(question))
+        with self._lock:
+            self._check_generation(scope)
+            self._entries[key] = {"value": value, "qvec": np.asarray(qvec, dtype="float32").reshape(-1), "created": time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "generation": self._generation,
+            }
+
+
+answer_cache = AnswerCache()
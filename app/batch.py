@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+from app.utils.ollama_client import get_client
+from app.query import embed_queries, search_many, build_retrieval, answer_scope, LLM_MODEL, NO_MATCH, TOP_K
+from app.query_multi import (route_model, default_quorum, settle, ok_candidate, quorum_reached, LLM_MODELS, JUDGE_MODEL,
+                             CONSENSUS_TIMEOUT)
+from app.answer_cache import answer_cache, normalize_question
+from app.metrics import timed, collect_timings
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+
+
+def normalize_items(items: Iterable[Union[str, Dict]]) -> List[Dict]:
+    out = []
+    for n, item in enumerate(items):
+        if isinstance(item, str):
+            item = {"question": item}
+        question = (item.get("question") or "").strip()
+        if not question:
+            raise ValueError(f"Batch item {n} has no question")
+        out.append({**item, "id": item.get("id", n), "question": question})
+    return out
+
+
+def read_questions(path: Path) -> List[Dict]:
+    """JSONL with one {"id": ..., "question": ...} object or JSON string per line; plain text lines are taken as questions."""
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError:
+                items.append(line)
+    return normalize_items(items)
+
+
+def ask_batch(items: Iterable[Union[str, Dict]], k: int = TOP_K, mode: str = "off", models: Optional[List[str]] = None,
+              judge_model: Optional[str] = None, concurrency: int = BATCH_CONCURRENCY,
+              filters: Optional[Dict] = None) -> Iterator[Dict]:
+    """Answer many questions, yielding one result dict per question as it completes.
+
+    Questions are embedded in one batch and searched as one matrix query. Generations are queued
+    model by model so Ollama keeps each model loaded, and at most `concurrency` run at once.
+    `filters` (docs/paths/pages) restrict retrieval for every question in the batch.
+    """
+    items = normalize_items(items)
+    mode = (mode or "off").lower()
+    client = get_client()
+    started = time.perf_counter()
+
+    if mode == "consensus":
+        models = models or LLM_MODELS[:3]
+        judge_model = judge_model or JUDGE_MODEL
+        for it in items:
+            it["scope"] = answer_scope("consensus", k, models, judge_model, filters)
+    else:
+        for it in items:
+            it["model"] = route_model(it["question"], models) if mode == "router" else LLM_MODEL
+            it["scope"] = answer_scope("single", k, [it["model"]], filters=filters)
+
+    def results(it: Dict, **fields) -> Iterator[Dict]:
+        elapsed = round((time.perf_counter() - started) * 1000, 1)
+        for each in [it] + it.get("followers", []):
+            yield {"id": each["id"], "question": each["question"], **fields, "elapsed_ms": elapsed}
+
+    todo = []
+    leaders: Dict[tuple, Dict] = {}
+    for it in items:
+        hit = answer_cache.get(it["scope"], it["question"])
+        if hit is not None:
+            yield from results(it, **hit)
+            continue
+        # repeated questions in one batch share a single generation
+        leader = leaders.setdefault((it["scope"], normalize_question(it["question"])), it)
+        if leader is it:
+            todo.append(it)
+        else:
+            leader.setdefault("followers", []).append(it)
+    if not todo:
+        return
+
+    with timed("ollama_embed"):
+        qvs = embed_queries([it["question"] for it in todo], client)
+    pending = []
+    for it, qv in zip(todo, qvs):
+        it["qv"] = qv
+        hit = answer_cache.get_similar(it["scope"], qv)
+        if hit is not None:
+            yield from results(it, **hit)
+        else:
+            pending.append(it)
+    if not pending:
+        return
+
+    hits = search_many([it["question"] for it in pending], [it["qv"] for it in pending], k, filters)
+    for it, (chunks, ids) in zip(pending, hits):
+        it["retrieval"] = build_retrieval(it["question"], k, it["qv"], chunks, ids, filters)
+    for it in pending:
+        if it["retrieval"].no_match:
+            extra = {"candidates": [], "judge_ran": False} if mode == "consensus" else {"model": it["model"]}
+            yield from results(it, **it["retrieval"].result(NO_MATCH, **extra))
+    pending = [it for it in pending if not it["retrieval"].no_match]
+    if not pending:
+        return
+
+    if mode == "consensus":
+        # every candidate for every question, grouped by model, before any judge
+        jobs = [(m, it) for m in models for it in pending]
+    else:
+        order = {m: n for n, m in enumerate(dict.fromkeys(it["model"] for it in pending))}
+        jobs = [(it["model"], it) for it in sorted(pending, key=lambda it: order[it["model"]])]
+
+    def chat(model: str, messages: List[Dict], abort: Optional[threading.Event] = None,
+             on_reply: Optional[Callable[[str], None]] = None) -> Dict:
+        t0 = time.perf_counter()
+        with collect_timings() as spent:
+            answer = client.chat(model=model, messages=messages, timeout=CONSENSUS_TIMEOUT if mode == "consensus" else 600,
+                                 abort=abort, on_reply=on_reply)
+        return ok_candidate(model, answer, t0, spent)
+
+    pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    quorum = default_quorum(len(models)) if mode == "consensus" else 1
+    for it in pending:
+        it["abandoned"] = threading.Event()
+        it["on_reply"] = quorum_reached(quorum, it["abandoned"]) if mode == "consensus" else None
+    futures = {pool.submit(chat, m, it["retrieval"].messages, it["abandoned"], it["on_reply"]): ("answer", m, it)
+               for m, it in jobs}
+
+    def start_judge(it: Dict) -> List[Dict]:
+        it["judging"] = True
+        # candidates not yet started are cancelled; ones queued for a model slot withdraw via the abort event
+        it["abandoned"].set()
+        for other, (kind, _, other_it) in list(futures.items()):
+            if other_it is it and kind == "answer":
+                other.cancel()
+                del futures[other]
+        cands = it["candidates"]
+        it["candidate_list"] = [cands.get(m) or {"model": m, "answer": "", "latency_ms": None, "status": "skipped"} for m in models]
+        try:
+            verdict = settle(client, it["retrieval"], it["candidate_list"], judge_model)
+        except RuntimeError as e:
+            return list(results(it, error=str(e), candidates=it["candidate_list"]))
+        if verdict.judge_messages is None:
+            out = it["retrieval"].result(verdict.answer, **verdict.fields)
+            answer_cache.put(it["scope"], it["question"], it["qv"], out)
+            return list(results(it, **out))
+        it["verdict"] = verdict
+        futures[pool.submit(chat, judge_model, verdict.judge_messages)] = ("judge", judge_model, it)
+        return []
+
+    try:
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f not in futures:
+                    continue  # a candidate dropped by start_judge() for a question decided earlier in this batch
+                kind, model, it = futures.pop(f)
+                try:
+                    cand = f.result()
+                    error = None
+                except CancelledError:
+                    continue  # withdrawn once the question reached quorum; start_judge() marks it skipped
+                except Exception as e:
+                    error = str(e)
+                    cand = {"model": model, "answer": "", "latency_ms": None, "status": "error", "error": error}
+                answer = cand["answer"]
+
+                if kind == "answer" and mode == "consensus":
+                    cands = it.setdefault("candidates", {})
+                    cands[model] = cand
+                    ok = sum(c["status"] == "ok" for c in cands.values())
+                    if not it.get("judging") and (ok >= quorum or len(cands) == len(models)):
+                        yield from start_judge(it)
+                    continue
+
+                if kind == "judge":
+                    extra = it["verdict"].fields
+                else:
+                    extra = {"model": model}
+                if error:
+                    yield from results(it, error=error, **extra)
+                    continue
+                out = it["retrieval"].result(answer, **extra)
+                answer_cache.put(it["scope"], it["question"], it["qv"], out)
+                yield from results(it, **out)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,128 @@
+import os
+import re
+import math
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+BM25_K1 = float(os.getenv("BM25_K1", 1.2))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN_RE.findall(text.lower()) if len(t) > 2]
+
+
+def _postings(texts: Iterable[str], vocab: dict, start_doc: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    term_ids: List[int] = []
+    doc_ids: List[int] = []
+    tfs: List[int] = []
+    doc_lens: List[int] = []
+    for doc, text in enumerate(texts, start=start_doc):
+        toks = tokenize(text or "")
+        doc_lens.append(len(toks))
+        for tok, tf in Counter(toks).items():
+            tid = vocab.get(tok)
+            if tid is None:
+                tid = vocab[tok] = len(vocab)
+            term_ids.append(tid)
+            doc_ids.append(doc)
+            tfs.append(tf)
+    return (np.array(term_ids, dtype="int64"), np.array(doc_ids, dtype="int64"),
+            np.array(tfs, dtype="int32"), np.array(doc_lens, dtype="int32"))
+
+
+class BM25Index:
+    def __init__(self, vocab: dict, offsets: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray, doc_lens: np.ndarray):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lens = doc_lens
+        self.avgdl = float(doc_lens.mean()) if len(doc_lens) else 0.0
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_lens)
+
+    @classmethod
+    def _from_triplets(cls, vocab: dict, term_ids: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray, doc_lens: np.ndarray) -> "BM25Index":
+        order = np.argsort(term_ids, kind="stable")
+        counts = np.bincount(term_ids, minlength=len(vocab))
+        offsets = np.zeros(len(vocab) + 1, dtype="int64")
+        np.cumsum(counts, out=offsets[1:])
+        return cls(vocab, offsets, doc_ids[order].astype("int32"), tfs[order], doc_lens)
+
+    @classmethod
+    def build(cls, texts: Iterable[str]) -> "BM25Index":
+        vocab: dict = {}
+        term_ids, doc_ids, tfs, doc_lens = _postings(texts, vocab, 0)
+        return cls._from_triplets(vocab, term_ids, doc_ids, tfs, doc_lens)
+
+    def add(self, texts: Iterable[str]) -> "BM25Index":
+        vocab = dict(self.vocab)
+        term_ids, doc_ids, tfs, doc_lens = _postings(texts, vocab, self.n_docs)
+        old_terms = np.repeat(np.arange(len(self.offsets) - 1, dtype="int64"), np.diff(self.offsets))
+        return self._from_triplets(
+            vocab,
+            np.concatenate([old_terms, term_ids]),
+            np.concatenate([self.doc_ids.astype("int64"), doc_ids]),
+            np.concatenate([self.tfs, tfs]),
+            np.concatenate([self.doc_lens, doc_lens]),
+        )
+
+    def save(self, path: Path) -> None:
+        terms = sorted(self.vocab, key=self.vocab.get)
+        # replace rather than rewrite: the file may be hard-linked into a published store generation
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, terms=np.array(terms, dtype=str), offsets=self.offsets,
+                     doc_ids=self.doc_ids, tfs=self.tfs, doc_lens=self.doc_lens)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "BM25Index":
+        with np.load(path, allow_pickle=False) as z:
+            vocab = {t: i for i, t in enumerate(z["terms"].tolist())}
+            return cls(vocab, z["offsets"], z["doc_ids"], z["tfs"], z["doc_lens"])
+
+    def search(self, query: str, k: int, ranges: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k doc ids by BM25; `ranges` (starts, ends) restricts hits to those row runs."""
+        n = self.n_docs
+        ids_parts = []
+        score_parts = []
+        for tok in set(tokenize(query)):
+            tid = self.vocab.get(tok)
+            if tid is None:
+                continue
+            s, e = self.offsets[tid], self.offsets[tid + 1]
+            df = e - s
+            ids = self.doc_ids[s:e]
+            tf = self.tfs[s:e]
+            if ranges is not None:
+                # postings are sorted by doc id, so each run is one binary-searched slice
+                lo, hi = np.searchsorted(ids, ranges[0]), np.searchsorted(ids, ranges[1])
+                take = [np.arange(a, b) for a, b in zip(lo, hi) if b > a]
+                if not take:
+                    continue
+                take = np.concatenate(take)
+                ids, tf = ids[take], tf[take]
+            tf = tf.astype("float32")
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * self.doc_lens[ids] / (self.avgdl or 1.0))
+            ids_parts.append(ids)
+            score_parts.append(idf * tf * (BM25_K1 + 1.0) / (tf + norm))
+        if not ids_parts:
+            return np.zeros(0, dtype="int64"), np.zeros(0, dtype="float32")
+        uniq, inv = np.unique(np.concatenate(ids_parts), return_inverse=True)
+        scores = np.bincount(inv, weights=np.concatenate(score_parts))
+        if len(uniq) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(uniq))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return uniq[top].astype("int64"), scores[top].astype("float32")
@@ -0,0 +1,89 @@
+import os
+import json
+import mmap
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence
+
+import numpy as np
+
+OFFSETS_SUFFIX = ".offsets"
+SCAN_BLOCK = 16 << 20
+
+
+def offsets_path(chunks_path: Path) -> Path:
+    return chunks_path.with_name(chunks_path.name + OFFSETS_SUFFIX)
+
+
+def _scan_line_starts(chunks_path: Path, start: int) -> np.ndarray:
+    starts = []
+    with open(chunks_path, "rb") as f:
+        f.seek(start)
+        pos = start
+        while True:
+            block = f.read(SCAN_BLOCK)
+            if not block:
+                break
+            nl = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+            starts.append(nl.astype("uint64") + np.uint64(pos + 1))
+            pos += len(block)
+    return np.concatenate(starts) if starts else np.zeros(0, dtype="uint64")
+
+
+def ensure_offsets(chunks_path: Path) -> np.ndarray:
+    st = chunks_path.stat()
+    path = offsets_path(chunks_path)
+    offsets = np.zeros(1, dtype="uint64")
+    if path.exists():
+        # first word is the inode of chunks.jsonl: appends keep it, rewrites replace the file
+        existing = np.memmap(path, dtype="uint64", mode="r")
+        if len(existing) > 1 and int(existing[0]) == st.st_ino and existing[1] == 0 and existing[-1] <= st.st_size:
+            offsets = existing[1:]
+    if int(offsets[-1]) == st.st_size:
+        return offsets
+    offsets = np.concatenate([offsets, _scan_line_starts(chunks_path, int(offsets[-1]))])
+    try:
+        tmp = path.with_name(path.name + ".tmp")
+        np.concatenate([np.array([st.st_ino], dtype="uint64"), offsets]).tofile(tmp)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return offsets
+
+
+class ChunkStore:
+    def __init__(self, chunks_path: Path):
+        self.path = chunks_path
+        self.offsets = ensure_offsets(chunks_path)
+        self._file = open(chunks_path, "rb")
+        size = int(self.offsets[-1])
+        self._mm = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> Dict:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"chunk {i} out of range (0..{len(self) - 1})")
+        return json.loads(self._mm[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def get_many(self, ids: Sequence[int]) -> List[Dict]:
+        """Chunks for `ids` in the given order; offsets are looked up at once and rows read in file order."""
+        ids = np.asarray(ids, dtype="int64")
+        if len(ids) and (ids.min() < 0 or ids.max() >= len(self)):
+            raise IndexError(f"chunk ids out of range (0..{len(self) - 1})")
+        starts, ends = self.offsets[ids], self.offsets[ids + 1]
+        out: List[Dict] = [None] * len(ids)
+        for n in np.argsort(starts, kind="stable"):
+            out[n] = json.loads(self._mm[int(starts[n]):int(ends[n])])
+        return out
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self) -> None:
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._file.close()
@@ -1,15 +1,69 @@
 import os
-from app.query import ask as ask_single
-from app.query_multi import ask_router, ask_consensus
+import sys
+import json
+import argparse
+from pathlib import Path
+
+from app.query import ask_stream, TOP_K
+from app.query_multi import ask_router_stream, ask_consensus_stream
+from app.store import get_store
+from app.batch import ask_batch, read_questions, BATCH_CONCURRENCY
+from app.doc_map import normalize_filters
 
 MODE = os.getenv("ENSEMBLE_MODE", "off").lower()
 
-BANNER = f"""PDF QA (v4) — Mode: {MODE.upper()}
+BANNER = """PDF QA (v4) — Mode: {mode}
 Type your questions. Ctrl+C to exit.
 """
 
+def page_range(value: str) -> list[int]:
+    first, _, last = value.partition("-")
+    try:
+        return [int(first), int(last or first)]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a page or range like 3-10, got {value!r}")
+
+def run_batch(path: Path, out_path: Path | None, mode: str, k: int, concurrency: int, filters: dict | None = None) -> None:
+    items = read_questions(path)
+    print(f"Answering {len(items)} questions (mode={mode}, concurrency={concurrency})...", file=sys.stderr)
+    out = open(out_path, "w", encoding="utf-8") if out_path else sys.stdout
+    errors = 0
+    try:
+        for n, res in enumerate(ask_batch(items, k=k, mode=mode, concurrency=concurrency, filters=filters), start=1):
+            errors += "error" in res
+            out.write(json.dumps(res, ensure_ascii=False) + "\n")
+            out.flush()
+            print(f"\r{n}/{len(items)} done, {errors} failed", end="", file=sys.stderr, flush=True)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(file=sys.stderr)
+
 def main():
-    print(BANNER)
+    ap = argparse.ArgumentParser(description="Ask questions about the ingested PDFs")
+    ap.add_argument("--batch", type=Path, help="answer every question in a JSONL file and write JSONL results")
+    ap.add_argument("--out", type=Path, help="write batch results here instead of stdout")
+    ap.add_argument("--mode", default=MODE, choices=["off", "router", "consensus"])
+    ap.add_argument("--top-k", type=int, default=TOP_K)
+    ap.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    ap.add_argument("--docs", help="only search these documents (comma-separated names or globs, e.g. 'manual*.pdf')")
+    ap.add_argument("--paths", help="only search documents under these paths (comma-separated globs)")
+    ap.add_argument("--pages", type=page_range, help="only search this page range, e.g. 3-10")
+    args = ap.parse_args()
+    try:
+        filters = normalize_filters({"docs": (args.docs or "").split(","), "paths": (args.paths or "").split(","),
+                                     "pages": args.pages})
+    except ValueError as e:
+        ap.error(str(e))
+    if args.batch:
+        run_batch(args.batch, args.out, args.mode, args.top_k, args.concurrency, filters)
+        return
+    interactive(args.mode, args.top_k, filters)
+
+def interactive(mode: str, k: int | None = None, filters: dict | None = None):
+    k = k or TOP_K
+    print(BANNER.format(mode=mode.upper()))
+    get_store()
     while True:
         try:
             q = input("\nYou: ")
@@ -18,12 +72,17 @@ def main():
             break
         if not q.strip():
             continue
-        if MODE == "router":
-            res = ask_router(q)
-        elif MODE == "consensus":
-            res = ask_consensus(q)
+        if mode == "router":
+            events = ask_router_stream(q, k=k, filters=filters)
+        elif mode == "consensus":
+            events = ask_consensus_stream(q, k=k, filters=filters)
         else:
-            res = ask_single(q)
-        print("\nAssistant:\n" + res["answer"])
+            events = ask_stream(q, k=k, filters=filters)
+        print("\nAssistant:")
+        for ev in events:
+            if ev["type"] == "token":
+                print(ev["content"], end="", flush=True)
+        print()
+
 if __name__ == "__main__":
     main()
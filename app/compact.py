@@ -0,0 +1,70 @@
+import json
+
+import faiss
+import numpy as np
+
+from app.bm25 import BM25Index
+from app.doc_map import DocMap
+from app.chunk_store import ensure_offsets
+from app.store import (INDEX_FILE, CHUNKS_FILE, BM25_FILE, VECTORS_FILE, DOCS_FILE, current_dir, new_generation, publish,
+                       load_tombstones, save_tombstones, read_manifest, write_manifest)
+from app.vector_index import index_config, build_index, reconstruct_all, storage_of, load_vectors, save_vectors, save_index
+
+
+def main():
+    base = current_dir()
+    dead = set(load_tombstones(base).tolist())
+    if not dead:
+        print("No retired chunks. Store is already compact.")
+        return
+
+    index = faiss.read_index(str(base / INDEX_FILE))
+    manifest = read_manifest(base)
+    live = np.array([i for i in range(index.ntotal) if i not in dead], dtype="int64")
+    print(f"Compacting store: keeping {len(live)} of {index.ntotal} vectors...")
+
+    # the float32 sidecar, when there is one, holds the exact vectors; compressed codes only reconstruct approximately
+    old_cfg = manifest.get("index") or {}
+    sidecar = load_vectors(base / VECTORS_FILE, index.d)
+    source = sidecar if sidecar is not None and len(sidecar) == index.ntotal else reconstruct_all(index)
+    vecs = np.ascontiguousarray(source[live], dtype="float32")
+    del sidecar, source
+    kind = old_cfg.get("type", "flat")
+    index_cfg = index_config(len(vecs), vecs.shape[1], kind, storage_of(old_cfg)) if len(vecs) else old_cfg or {"type": kind}
+
+    # files not rewritten below (fingerprints) are carried over as hard links
+    gen_dir = new_generation(base)
+    tmp_chunks = gen_dir / (CHUNKS_FILE + ".tmp")
+    texts, metas = [], []
+    with open(base / CHUNKS_FILE, "r", encoding="utf-8") as src, open(tmp_chunks, "w", encoding="utf-8") as dst:
+        for row, line in enumerate(src):
+            if row in dead:
+                continue
+            rec = json.loads(line)
+            texts.append(rec["text"])
+            metas.append(rec["meta"])
+            dst.write(line)
+    tmp_chunks.replace(gen_dir / CHUNKS_FILE)
+    ensure_offsets(gen_dir / CHUNKS_FILE)
+
+    new_index = build_index(vecs, index_cfg) if len(vecs) else faiss.IndexFlatIP(index.d)
+    save_index(new_index, gen_dir / INDEX_FILE)
+    BM25Index.build(texts).save(gen_dir / BM25_FILE)
+    DocMap.build(metas).save(gen_dir / DOCS_FILE)
+    if index_cfg.get("rescore"):
+        save_vectors(gen_dir / VECTORS_FILE, vecs)
+    else:
+        (gen_dir / VECTORS_FILE).unlink(missing_ok=True)
+    save_tombstones(np.zeros(0, dtype="int64"), gen_dir)
+
+    manifest["vector_count"] = int(new_index.ntotal)
+    manifest["dead_count"] = 0
+    manifest["index"] = index_cfg
+    manifest = write_manifest(manifest, gen_dir)
+    publish(gen_dir)
+
+    print(f"✅ Compaction complete. Generation {manifest['generation']}, {new_index.ntotal} vectors.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import os
+import re
+import math
+from typing import Dict, List, Set, Tuple
+
+NUM_CTX = int(os.getenv("NUM_CTX", 8192))
+ANSWER_RESERVE_TOKENS = int(os.getenv("ANSWER_RESERVE_TOKENS", 1024))
+CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", 3.5))
+CONTEXT_DEDUP = float(os.getenv("CONTEXT_DEDUP", 0.85))
+MIN_OVERLAP = 24
+MIN_BLOCK_TOKENS = 64
+
+
+def estimate_tokens(text: str) -> int:
+    # no tokenizer for the served models here; a conservative chars/token ratio keeps us under num_ctx
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def context_budget(fixed_text: str, num_ctx: int = NUM_CTX, reserve: int = ANSWER_RESERVE_TOKENS) -> int:
+    return max(0, num_ctx - reserve - estimate_tokens(fixed_text))
+
+
+def _overlap_merge(a: str, b: str) -> str | None:
+    """Return a+b with the shared suffix/prefix written once, or None if they do not overlap."""
+    if b in a:
+        return a
+    if a in b:
+        return b
+    probe = b[:MIN_OVERLAP]
+    if len(probe) < MIN_OVERLAP:
+        return None
+    p = a.find(probe, max(0, len(a) - len(b)))
+    while p != -1:
+        if b.startswith(a[p:]):
+            return a[:p] + b
+        p = a.find(probe, p + 1)
+    return None
+
+
+def _shingles(text: str) -> Set[Tuple[str, ...]]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < 3:
+        return {tuple(words)}
+    return {tuple(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def _covered(a: Set, b: Set) -> float:
+    """Fraction of a's shingles already present in b."""
+    if not a:
+        return 1.0
+    return len(a & b) / len(a)
+
+
+def block_label(n: int, doc: str, page: int) -> str:
+    return f"[{n}] {doc} p.{page}:\n"
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    cut = int((max_tokens - 1) * CHARS_PER_TOKEN)
+    head = text[:cut]
+    boundary = max(head.rfind("\n"), head.rfind(". "))
+    if boundary > cut // 2:
+        head = head[:boundary + 1]
+    return head.rstrip() + " …"
+
+
+def pack_context(retrieved: List[Dict], budget: int) -> Tuple[List[Dict], Dict]:
+    """Merge overlapping hits from the same doc/page, drop near-duplicates and fill `budget` tokens.
+
+    Blocks keep the rank of their best-ranked chunk. Returns (blocks, stats); each block has
+    n, doc, page, path, text and tokens (label included).
+    """
+    blocks: List[Dict] = []
+    merged = 0
+    for rec in retrieved:
+        meta = rec["meta"]
+        block = {"doc": meta["doc"], "page": meta["page"], "path": meta.get("path", ""), "text": rec["text"] or ""}
+        pos = len(blocks)
+        blocks.append(block)
+        # a new chunk can bridge two earlier blocks, so keep folding until nothing overlaps
+        while True:
+            for i, other in enumerate(blocks):
+                if i == pos or (other["doc"], other["page"]) != (block["doc"], block["page"]):
+                    continue
+                joined = _overlap_merge(other["text"], block["text"]) or _overlap_merge(block["text"], other["text"])
+                if joined is not None:
+                    break
+            else:
+                break
+            keep, gone = min(i, pos), max(i, pos)
+            block = {**blocks[keep], "text": joined}
+            blocks[keep] = block
+            del blocks[gone]
+            pos = keep
+            merged += 1
+
+    kept: List[Dict] = []
+    kept_shingles: List[Set] = []
+    duplicates = truncated = dropped = 0
+    used = 0
+    for block in blocks:
+        text = block["text"].strip()
+        if not text:
+            continue
+        sh = _shingles(text)
+        if any(_covered(sh, other) >= CONTEXT_DEDUP for other in kept_shingles):
+            duplicates += 1
+            continue
+        n = len(kept) + 1
+        label_tokens = estimate_tokens(block_label(n, block["doc"], block["page"])) + 1
+        tokens = label_tokens + estimate_tokens(text)
+        remaining = budget - used
+        if tokens > remaining:
+            if remaining - label_tokens < MIN_BLOCK_TOKENS:
+                dropped += 1
+                continue
+            text = _truncate(text, remaining - label_tokens)
+            tokens = label_tokens + estimate_tokens(text)
+            truncated += 1
+        kept.append({"n": n, "doc": block["doc"], "page": block["page"], "path": block["path"], "text": text, "tokens": tokens})
+        kept_shingles.append(sh)
+        used += tokens
+
+    stats = {
+        "chunks": len(retrieved),
+        "blocks": len(kept),
+        "merged": merged,
+        "duplicates": duplicates,
+        "truncated": truncated,
+        "dropped": dropped,
+        "budget_tokens": budget,
+        "context_tokens": used,
+    }
+    return kept, stats
@@ -0,0 +1,133 @@
+import os
+import json
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+def normalize_filters(filters: Optional[Dict]) -> Optional[Dict]:
+    """{"docs": [...], "paths": [...], "pages": [first, last]} with empty parts dropped; None when nothing filters."""
+    if not filters:
+        return None
+    out: Dict = {}
+    for key in ("docs", "paths"):
+        values = filters.get(key) or []
+        if isinstance(values, str):
+            values = [values]
+        values = sorted({v.strip() for v in values if v and v.strip()})
+        if values:
+            out[key] = values
+    pages = filters.get("pages")
+    if pages:
+        first, last = (int(pages[0]), int(pages[-1]))
+        if first > last:
+            raise ValueError(f"Page range {first}-{last} is empty")
+        out["pages"] = [first, last]
+    return out or None
+
+
+def filters_key(filters: Optional[Dict]) -> Optional[tuple]:
+    if not filters:
+        return None
+    return tuple((key, tuple(filters[key])) for key in sorted(filters))
+
+
+def row_ranges(rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorted row ids as half-open runs [start, end)."""
+    if not len(rows):
+        return np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64")
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = rows[np.concatenate([[0], breaks])]
+    ends = rows[np.concatenate([breaks - 1, [len(rows) - 1]])] + 1
+    return starts.astype("int64"), ends.astype("int64")
+
+
+def _match(value: str, patterns: List[str]) -> bool:
+    value = value.lower()
+    return any(fnmatchcase(value, p.lower()) for p in patterns)
+
+
+class DocMap:
+    """Document and page of every chunk row, with each document's rows grouped for filtered search."""
+
+    def __init__(self, paths: List[str], names: List[str], row_doc: np.ndarray, row_page: np.ndarray):
+        self.paths = paths
+        self.names = names
+        self.row_doc = row_doc
+        self.row_page = row_page
+        # rows of document d are order[bounds[d]:bounds[d + 1]], ascending
+        self.order = np.argsort(row_doc, kind="stable").astype("int64")
+        self.bounds = np.zeros(len(paths) + 1, dtype="int64")
+        np.cumsum(np.bincount(row_doc, minlength=len(paths)), out=self.bounds[1:])
+
+    def __len__(self) -> int:
+        return len(self.row_doc)
+
+    @classmethod
+    def build(cls, metas: Iterable[Dict]) -> "DocMap":
+        return cls([], [], np.zeros(0, dtype="int32"), np.zeros(0, dtype="int32")).add(metas)
+
+    @classmethod
+    def from_chunks(cls, chunks_path: Path) -> "DocMap":
+        with open(chunks_path, "r", encoding="utf-8") as f:
+            return cls.build(json.loads(line)["meta"] for line in f)
+
+    def add(self, metas: Iterable[Dict]) -> "DocMap":
+        paths, names = list(self.paths), list(self.names)
+        ids = {p: i for i, p in enumerate(paths)}
+        row_doc, row_page = [], []
+        for meta in metas:
+            path = meta.get("path") or meta.get("doc") or ""
+            d = ids.get(path)
+            if d is None:
+                d = ids[path] = len(paths)
+                paths.append(path)
+                names.append(meta.get("doc") or Path(path).name)
+            row_doc.append(d)
+            row_page.append(int(meta.get("page") or 0))
+        return DocMap(paths, names,
+                      np.concatenate([self.row_doc, np.array(row_doc, dtype="int32")]),
+                      np.concatenate([self.row_page, np.array(row_page, dtype="int32")]))
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, paths=np.array(self.paths, dtype=str), names=np.array(self.names, dtype=str),
+                     row_doc=self.row_doc, row_page=self.row_page)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "DocMap":
+        with np.load(path, allow_pickle=False) as z:
+            return cls(z["paths"].tolist(), z["names"].tolist(), z["row_doc"], z["row_page"])
+
+    def doc_ids(self, filters: Dict) -> np.ndarray:
+        docs, paths = filters.get("docs"), filters.get("paths")
+        if not docs and not paths:
+            return np.arange(len(self.paths), dtype="int64")
+        return np.array([d for d, (name, path) in enumerate(zip(self.names, self.paths))
+                         if (docs and _match(name, docs)) or (paths and _match(path, paths))], dtype="int64")
+
+    def rows(self, filters: Dict, dead: Optional[np.ndarray] = None) -> np.ndarray:
+        """Sorted live row ids matching the filters; work is proportional to the selected documents, not the corpus."""
+        parts = [self.order[self.bounds[d]:self.bounds[d + 1]] for d in self.doc_ids(filters)]
+        rows = np.sort(np.concatenate(parts)) if parts else np.zeros(0, dtype="int64")
+        if filters.get("pages"):
+            first, last = filters["pages"]
+            pages = self.row_page[rows]
+            rows = rows[(pages >= first) & (pages <= last)]
+        if dead is not None and len(dead):
+            rows = rows[~np.isin(rows, dead)]
+        return rows
+
+    def summary(self, dead: Optional[np.ndarray] = None) -> List[Dict]:
+        live = np.ones(len(self.row_doc), dtype=bool)
+        if dead is not None and len(dead):
+            live[dead[dead < len(live)]] = False
+        chunks = np.bincount(self.row_doc[live], minlength=len(self.paths))
+        pages = np.zeros(len(self.paths), dtype="int64")
+        np.maximum.at(pages, self.row_doc, self.row_page)
+        return [{"doc": name, "path": path, "chunks": int(chunks[d]), "pages": int(pages[d])}
+                for d, (name, path) in enumerate(zip(self.names, self.paths)) if chunks[d]]
@@ -0,0 +1,170 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+EMBED_CACHE = os.getenv("EMBED_CACHE", "on").lower() not in ("0", "off", "false", "no")
+EMBED_CACHE_DIR = Path(os.getenv("EMBED_CACHE_DIR", "cache/embeddings"))
+EMBED_CACHE_MAX_ROWS = int(os.getenv("EMBED_CACHE_MAX_ROWS", 2_000_000))
+EMBED_CACHE_DTYPE = os.getenv("EMBED_CACHE_DTYPE", "float16")
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", 1024))
+
+VECTORS_FILE = "vectors.bin"
+ROWS_FILE = "rows.npz"
+META_FILE = "meta.json"
+MIN_CAPACITY = 1024
+
+
+def text_key(text: str) -> bytes:
+    normalized = " ".join(text.split())
+    return hashlib.sha1(normalized.encode("utf-8", errors="ignore")).hexdigest().encode("ascii")
+
+
+class EmbeddingCache:
+    def __init__(self, model: str, root: Path = EMBED_CACHE_DIR, max_rows: int = EMBED_CACHE_MAX_ROWS,
+                 dtype: str = EMBED_CACHE_DTYPE):
+        self.dir = Path(root) / re.sub(r"[^A-Za-z0-9_.-]+", "_", model)
+        self.max_rows = max(1, max_rows)
+        self.dtype = dtype
+        self.dim = 0
+        self.capacity = 0
+        self.tick = 0
+        self.vectors = None
+        self.row_keys = np.zeros(0, dtype="S40")
+        self.row_ticks = np.zeros(0, dtype="int64")
+        self.rows: Dict[bytes, int] = {}
+        self._load()
+
+    def _load(self) -> None:
+        meta_path = self.dir / META_FILE
+        if not meta_path.exists():
+            return
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        self.dim, self.capacity, self.tick, self.dtype = meta["dim"], meta["capacity"], meta["tick"], meta["dtype"]
+        with np.load(self.dir / ROWS_FILE, allow_pickle=False) as z:
+            self.row_keys = z["keys"]
+            self.row_ticks = z["ticks"]
+        self.rows = {k: i for i, k in enumerate(self.row_keys.tolist())}
+        self.vectors = np.memmap(self.dir / VECTORS_FILE, dtype=self.dtype, mode="r+", shape=(self.capacity, self.dim))
+
+    def __len__(self) -> int:
+        return len(self.row_keys)
+
+    def _ensure_capacity(self, rows_needed: int, dim: int) -> None:
+        if self.dim and self.dim != dim:
+            raise ValueError(f"Embedding cache at {self.dir} holds {self.dim}-d vectors, got {dim}-d")
+        if rows_needed <= self.capacity:
+            return
+        capacity = min(self.max_rows, max(MIN_CAPACITY, self.capacity * 2, rows_needed))
+        self.dir.mkdir(parents=True, exist_ok=True)
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        with open(self.dir / VECTORS_FILE, "ab") as f:
+            f.truncate(capacity * dim * np.dtype(self.dtype).itemsize)
+        self.dim, self.capacity = dim, capacity
+        self.vectors = np.memmap(self.dir / VECTORS_FILE, dtype=self.dtype, mode="r+", shape=(capacity, dim))
+
+    def lookup(self, keys: Sequence[bytes]) -> np.ndarray:
+        self.tick += 1
+        rows = np.array([self.rows.get(k, -1) for k in keys], dtype="int64")
+        hit = rows[rows >= 0]
+        if len(hit):
+            self.row_ticks[hit] = self.tick
+        return rows
+
+    def get(self, rows: np.ndarray) -> np.ndarray:
+        return np.asarray(self.vectors[rows], dtype="float32")
+
+    def put(self, keys: List[bytes], vecs: np.ndarray) -> None:
+        if not keys:
+            return
+        self.tick += 1
+        # a key repeated within the batch gets one row (its last vector)
+        fresh = list(dict((k, i) for i, k in enumerate(keys) if k not in self.rows).items())
+        if len(fresh) > self.max_rows:
+            fresh = fresh[-self.max_rows:]
+        used = len(self.row_keys)
+        grow = min(len(fresh), self.max_rows - used)
+        self._ensure_capacity(used + grow, vecs.shape[1])
+
+        targets = list(range(used, used + grow))
+        if grow:
+            self.row_keys = np.concatenate([self.row_keys, np.zeros(grow, dtype="S40")])
+            self.row_ticks = np.concatenate([self.row_ticks, np.zeros(grow, dtype="int64")])
+        evict = len(fresh) - grow
+        if evict > 0:
+            victims = np.argpartition(self.row_ticks[:used], evict - 1)[:evict]
+            for row in victims.tolist():
+                # caches written before batch keys were deduped can hold rows no key points at
+                key = self.row_keys[row]
+                if self.rows.get(key) == row:
+                    del self.rows[key]
+            targets.extend(victims.tolist())
+
+        for row, (key, i) in zip(targets, fresh):
+            self.vectors[row] = vecs[i]
+            self.row_keys[row] = key
+            self.row_ticks[row] = self.tick
+            self.rows[key] = row
+
+    def save(self) -> None:
+        if self.vectors is None:
+            return
+        self.vectors.flush()
+        with open(self.dir / (ROWS_FILE + ".tmp"), "wb") as f:
+            np.savez(f, keys=self.row_keys, ticks=self.row_ticks)
+        os.replace(self.dir / (ROWS_FILE + ".tmp"), self.dir / ROWS_FILE)
+        meta = {"dim": self.dim, "capacity": self.capacity, "tick": self.tick, "dtype": self.dtype}
+        (self.dir / META_FILE).write_text(json.dumps(meta), encoding="utf-8")
+
+
+class QueryEmbeddingLRU:
+    """In-process LRU of normalized question embeddings keyed by (embed model, question)."""
+
+    def __init__(self, max_entries: int = QUERY_EMBED_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(model: str, question: str) -> tuple:
+        return model, " ".join(question.split())
+
+    def get(self, model: str, question: str) -> Optional[np.ndarray]:
+        key = self._key(model, question)
+        with self._lock:
+            vec = self._entries.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, model: str, question: str, vec: np.ndarray) -> None:
+        if self.max_entries <= 0:
+            return
+        vec = np.array(vec, dtype="float32").reshape(1, -1)
+        vec.setflags(write=False)
+        key = self._key(model, question)
+        with self._lock:
+            self._entries[key] = vec
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"size": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+
+query_embeddings = QueryEmbeddingLRU()
@@ -1,82 +1,170 @@
 import os
 import json
 from pathlib import Path
-from typing import Dict, List, Set
+from typing import Dict, List, Set, Tuple
 
-import numpy as np
 import faiss
-from dotenv import load_dotenv
-from tqdm import tqdm
+import numpy as np
 
 from app.utils.ollama_client import OllamaClient
-from app.utils.hash_utils import make_uid
-from app.ingest import build_corpus, l2_normalize, STORE_DIR, EMBED_MODEL
+from app.utils.hash_utils import make_uid, file_sha1
+from app.ingest import extract_chunks, embed_texts, DATA_DIR
+from app.store import (INDEX_FILE, CHUNKS_FILE, BM25_FILE, VECTORS_FILE, DOCS_FILE, current_dir, new_generation, publish,
+                       load_fingerprints, save_fingerprints, load_tombstones, save_tombstones, read_manifest, write_manifest)
+from app.bm25 import BM25Index
+from app.doc_map import DocMap
+from app.chunk_store import ensure_offsets
+from app.vector_index import index_config, build_index, save_index, save_vectors, append_vectors
+from app.metrics import Throughput
 
-load_dotenv()
+def load_or_rebuild_bm25(store_dir: Path) -> BM25Index:
+    bm25_path = store_dir / BM25_FILE
+    if bm25_path.exists():
+        return BM25Index.load(bm25_path)
+    texts: List[str] = []
+    chunks_path = store_dir / CHUNKS_FILE
+    if chunks_path.exists():
+        with open(chunks_path, "r", encoding="utf-8") as f:
+            for line in f:
+                texts.append(json.loads(line)["text"])
+    return BM25Index.build(texts)
 
-def load_existing_uids_and_index():
-    index_path = STORE_DIR / "index.faiss"
-    chunks_path = STORE_DIR / "chunks.jsonl"
+def load_or_rebuild_docmap(store_dir: Path) -> DocMap:
+    docs_path = store_dir / DOCS_FILE
+    if docs_path.exists():
+        return DocMap.load(docs_path)
+    chunks_path = store_dir / CHUNKS_FILE
+    return DocMap.from_chunks(chunks_path) if chunks_path.exists() else DocMap.build([])
+
+def load_existing_uids_and_index(store_dir: Path, stale_paths: Set[str] = frozenset(), dead: Set[int] = frozenset()):
+    index_path = store_dir / INDEX_FILE
+    chunks_path = store_dir / CHUNKS_FILE
     have_index = index_path.exists() and chunks_path.exists()
     uids: Set[str] = set()
+    stale_rows: List[int] = []
     if chunks_path.exists():
         with open(chunks_path, "r", encoding="utf-8") as f:
-            for line in f:
+            for row, line in enumerate(f):
+                if row in dead:
+                    continue
                 obj = json.loads(line)
-                if "uid" in obj:
+                if obj["meta"].get("path") in stale_paths:
+                    stale_rows.append(row)
+                elif "uid" in obj:
                     uids.add(obj["uid"])
                 else:
                     uids.add(make_uid(obj["meta"], obj["text"]))
     index = faiss.read_index(str(index_path)) if have_index else None
-    return index, uids
+    return index, uids, stale_rows
+
+def changed_pdfs(fingerprints: Dict[str, Dict]) -> Tuple[List[Path], List[str], List[str]]:
+    changed: List[Path] = []
+    modified: List[str] = []
+    on_disk = sorted(DATA_DIR.glob("*.pdf"))
+    for pdf in on_disk:
+        key = str(pdf)
+        st = pdf.stat()
+        old = fingerprints.get(key)
+        if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+            continue
+        digest = file_sha1(pdf)
+        fresh = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": digest}
+        if old and old["sha1"] == digest:
+            fingerprints[key] = fresh
+            continue
+        changed.append(pdf)
+        if old:
+            modified.append(key)
+        fingerprints[key] = fresh
+    present = {str(pdf) for pdf in on_disk}
+    removed = [key for key in fingerprints if key not in present]
+    for key in removed:
+        del fingerprints[key]
+    return changed, modified, removed
 
 def main():
     client = OllamaClient()
     if not client.is_alive():
         raise SystemExit("Ollama is not reachable. Ensure it's running and OLLAMA_HOST is correct.")
 
-    index, existing_uids = load_existing_uids_and_index()
-    texts, metas = build_corpus()
+    base = current_dir()
+    fingerprints = load_fingerprints(base)
+    pdfs, modified, removed = changed_pdfs(fingerprints)
+    if not pdfs and not removed:
+        # published generations are immutable; touched-but-identical PDFs are simply re-hashed next run
+        print("No new, modified or removed PDFs detected. Nothing to do.")
+        return
 
+    print(f"{len(pdfs)} new or modified PDF(s), {len(removed)} removed.")
+    dead = set(load_tombstones(base).tolist())
+    index, existing_uids, stale_rows = load_existing_uids_and_index(base, set(modified) | set(removed), dead)
+    dead.update(stale_rows)
+    if stale_rows:
+        print(f"Retiring {len(stale_rows)} chunks from modified or removed PDFs.")
+
+    stats = Throughput()
     new_items: List[Dict] = []
-    for meta, text in zip(metas, texts):
-        uid = make_uid(meta, text)
-        if uid not in existing_uids:
-            new_items.append({"uid": uid, "meta": meta, "text": text})
+    for pdf in pdfs:
+        with stats.timed("extract"):
+            texts, metas = extract_chunks(pdf, stats)
+        stats.add("chunks", len(texts))
+        for meta, text in zip(metas, texts):
+            uid = make_uid(meta, text)
+            if uid not in existing_uids:
+                existing_uids.add(uid)
+                new_items.append({"uid": uid, "meta": meta, "text": text})
 
-    if not new_items:
-        print("No new chunks detected. Nothing to do.")
-        return
+    index_cfg = None
+    gen_dir = None
+    if new_items:
+        print(f"Embedding {len(new_items)} NEW chunks...")
+        vecs = embed_texts(client, [rec["text"] for rec in new_items], stats=stats)
+        # chunks and vectors are appended to, so the new generation gets its own copies of them
+        gen_dir = new_generation(base, copy=(CHUNKS_FILE, VECTORS_FILE))
+
+        if index is None:
+            index_cfg = index_config(vecs.shape[0], vecs.shape[1])
+            index = build_index(vecs, index_cfg)
+            if index_cfg["rescore"]:
+                save_vectors(gen_dir / VECTORS_FILE, vecs)
+        else:
+            index.add(vecs)
+            if read_manifest(base).get("index", {}).get("rescore"):
+                append_vectors(gen_dir / VECTORS_FILE, vecs)
+
+        save_index(index, gen_dir / INDEX_FILE)
+
+        bm25 = load_or_rebuild_bm25(base)
+        with open(gen_dir / CHUNKS_FILE, "a", encoding="utf-8") as f:
+            for rec in new_items:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        ensure_offsets(gen_dir / CHUNKS_FILE)
+        bm25.add([rec["text"] for rec in new_items]).save(gen_dir / BM25_FILE)
+        load_or_rebuild_docmap(base).add(rec["meta"] for rec in new_items).save(gen_dir / DOCS_FILE)
+    else:
+        if not stale_rows:
+            print("No new chunks detected; publishing the updated fingerprints only.")
+        gen_dir = new_generation(base)
+
+    save_tombstones(np.array(sorted(dead), dtype="int64"), gen_dir)
+    save_fingerprints(fingerprints, gen_dir)
+
+    manifest = read_manifest(base)
+    total = int(index.ntotal) if index is not None else 0
+    manifest["vector_count"] = total
+    manifest["dead_count"] = len(dead)
+    if index_cfg is not None:
+        manifest["index"] = index_cfg
+    manifest["incremental_stats"] = stats.report()
+    manifest = write_manifest(manifest, gen_dir)
+    publish(gen_dir)
+
+    print(stats.summary())
 
-    print(f"Embedding {len(new_items)} NEW chunks...")
-    vecs_list = []
-    for rec in tqdm(new_items):
-        vecs_list.append(client.embed(rec["text"], EMBED_MODEL))
-    vecs = np.array(vecs_list, dtype="float32")
-    vecs = l2_normalize(vecs)
-
-    if index is None:
-        dim = vecs.shape[1]
-        index = faiss.IndexFlatIP(dim)
-    index.add(vecs)
-
-    faiss.write_index(index, str(STORE_DIR / "index.faiss"))
-
-    with open(STORE_DIR / "chunks.jsonl", "a", encoding="utf-8") as f:
-        for rec in new_items:
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
-
-    manifest_path = STORE_DIR / "manifest.json"
-    manifest = {}
-    if manifest_path.exists():
-        try:
-            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
-        except Exception:
-            manifest = {}
-    manifest["vector_count"] = int(index.ntotal)
-    manifest_path.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
-
-    print("✅ Incremental ingest complete. Index updated.")
+    print(f"✅ Incremental ingest complete. Published generation {manifest['generation']} "
+          f"({total - len(dead)} live, {len(dead)} retired chunks).")
+    if dead and len(dead) > total // 4:
+        print("Tip: run `python -m app.compact` to reclaim space from retired chunks.")
 
 if __name__ == "__main__":
     main()
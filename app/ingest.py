@@ -1,22 +1,27 @@
 import os
 import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 from typing import List, Dict
 
 import numpy as np
-import faiss
 from pypdf import PdfReader
-from dotenv import load_dotenv
 from tqdm import tqdm
 
 from app.utils.ollama_client import OllamaClient
-from app.utils.hash_utils import make_uid
-from app.ocr import page_needs_ocr, ocr_with_pytesseract, ocrmypdf_available, ocr_with_ocrmypdf
-
-load_dotenv()
+from app.utils.hash_utils import make_uid, file_fingerprint
+from app.ocr import page_needs_ocr, ocr_pages, ocr_with_pytesseract, ocrmypdf_available, ocr_with_ocrmypdf
+from app.store import (STORE_DIR, INDEX_FILE, CHUNKS_FILE, BM25_FILE, VECTORS_FILE, DOCS_FILE, new_generation, publish,
+                       save_fingerprints, write_manifest)
+from app.bm25 import BM25Index
+from app.doc_map import DocMap
+from app.chunk_store import ensure_offsets
+from app.embed_cache import EMBED_CACHE, EmbeddingCache, text_key
+from app.vector_index import index_config, build_index, bytes_per_vector, save_index
+from app.metrics import Throughput
 
 DATA_DIR = Path("data")
-STORE_DIR = Path("store")
 STORE_DIR.mkdir(exist_ok=True)
 
 EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
@@ -24,6 +29,8 @@ CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1200))
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 200))
 OCR_MODE = os.getenv("OCR_MODE", "auto").lower()
 OCR_LANGS = os.getenv("OCR_LANGS", "eng")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 0)) or (os.cpu_count() or 1)
+STAGING_DIR = STORE_DIR / ".ingest"
 
 def extract_pdf_text_native(pdf_path: Path) -> List[Dict]:
     reader = PdfReader(str(pdf_path))
@@ -48,23 +55,24 @@ def extract_pdf_text_with_ocr(pdf_path: Path) -> List[Dict]:
         else:
             try:
                 searchable_pdf = ocr_with_ocrmypdf(pdf_path, lang=OCR_LANGS)
-                return extract_pdf_text_native(searchable_pdf)
+                return [{**p, "ocr": True} for p in extract_pdf_text_native(searchable_pdf)]
             except Exception as e:
                 print(f"WARN: ocrmypdf failed ({e}). Falling back to 'pytesseract'.")
                 mode = "pytesseract"
 
     if mode == "pytesseract":
         ocr_texts = ocr_with_pytesseract(pdf_path, dpi=300, lang=OCR_LANGS)
-        return [{"page": i+1, "text": t} for i, t in enumerate(ocr_texts)]
+        return [{"page": i+1, "text": t, "ocr": True} for i, t in enumerate(ocr_texts)]
 
     native_pages = extract_pdf_text_native(pdf_path)
     pages_texts = [p["text"] for p in native_pages]
     need_idx = [i for i, txt in enumerate(pages_texts) if page_needs_ocr(txt)]
     if need_idx:
-        ocr_pages = ocr_with_pytesseract(pdf_path, dpi=300, lang=OCR_LANGS)
+        ocr_texts = ocr_pages(pdf_path, [i + 1 for i in need_idx], dpi=300, lang=OCR_LANGS)
         for i in need_idx:
-            pages_texts[i] = ocr_pages[i] if i < len(ocr_pages) else pages_texts[i]
-    return [{"page": i+1, "text": t} for i, t in enumerate(pages_texts)]
+            pages_texts[i] = ocr_texts.get(i + 1) or pages_texts[i]
+    need = set(need_idx)
+    return [{"page": i+1, "text": t, "ocr": i in need} for i, t in enumerate(pages_texts)]
 
 def chunk_text(text: str, chunk_size: int, overlap: int) -> List[str]:
     text = text.replace("\r", "\n")
@@ -90,25 +98,38 @@ def chunk_text(text: str, chunk_size: int, overlap: int) -> List[str]:
         start = max(0, end - overlap)
     return chunks
 
-def build_corpus() -> tuple[list[str], list[dict]]:
-    texts: list[str] = []
-    metas: list[dict] = []
-
+def list_pdfs() -> List[Path]:
     pdfs = sorted(DATA_DIR.glob("*.pdf"))
     if not pdfs:
         raise SystemExit("No PDFs found in ./data. Please add files and retry.")
+    return pdfs
+
+def extract_chunks(pdf: Path, stats: Throughput | None = None) -> tuple[list[str], list[dict]]:
+    texts: list[str] = []
+    metas: list[dict] = []
+    pages = extract_pdf_text_with_ocr(pdf)
+    if stats is not None:
+        stats.add("pages", len(pages))
+        stats.add("ocr_pages", sum(1 for p in pages if p.get("ocr")))
+    for p in pages:
+        page_num = p["page"]
+        page_text = p["text"]
+        if not page_text:
+            continue
+        for chunk in chunk_text(page_text, CHUNK_SIZE, CHUNK_OVERLAP):
+            meta = {"doc": pdf.name, "path": str(pdf), "page": page_num}
+            texts.append(chunk)
+            metas.append(meta)
+    return texts, metas
+
+def build_corpus(pdfs: List[Path] | None = None) -> tuple[list[str], list[dict]]:
+    texts: list[str] = []
+    metas: list[dict] = []
 
-    for pdf in pdfs:
-        pages = extract_pdf_text_with_ocr(pdf)
-        for p in pages:
-            page_num = p["page"]
-            page_text = p["text"]
-            if not page_text:
-                continue
-            for chunk in chunk_text(page_text, CHUNK_SIZE, CHUNK_OVERLAP):
-                meta = {"doc": pdf.name, "path": str(pdf), "page": page_num}
-                texts.append(chunk)
-                metas.append(meta)
+    for pdf in (list_pdfs() if pdfs is None else pdfs):
+        pdf_texts, pdf_metas = extract_chunks(pdf)
+        texts.extend(pdf_texts)
+        metas.extend(pdf_metas)
     if not texts:
         raise SystemExit("No extractable text found in PDFs (even after OCR).")
     return texts, metas
@@ -119,49 +140,235 @@ def l2_normalize(mat: np.ndarray) -> np.ndarray:
     norms[norms == 0] = 1.0
     return mat / norms
 
+def embed_texts(client: OllamaClient, texts: List[str], cache: EmbeddingCache | None = None, progress=None,
+                stats: Throughput | None = None) -> np.ndarray:
+    if stats is not None:
+        with stats.timed("embed"):
+            return _embed_texts(client, texts, cache, progress, stats)
+    return _embed_texts(client, texts, cache, progress, stats)
+
+def _embed_texts(client: OllamaClient, texts: List[str], cache: EmbeddingCache | None, progress,
+                 stats: Throughput | None) -> np.ndarray:
+    if not EMBED_CACHE:
+        if stats is not None:
+            stats.add("embeddings", len(texts))
+        if progress:
+            return l2_normalize(client.embed_many(texts, EMBED_MODEL, progress=progress))
+        with tqdm(total=len(texts)) as bar:
+            vecs = client.embed_many(texts, EMBED_MODEL, progress=bar.update)
+        return l2_normalize(vecs)
+
+    own_cache = cache is None
+    cache = cache or EmbeddingCache(EMBED_MODEL)
+    keys = [text_key(t) for t in texts]
+    rows = cache.lookup(keys)
+    hit = np.flatnonzero(rows >= 0)
+    missing = np.flatnonzero(rows < 0)
+    if progress is None:
+        print(f"Embedding cache: {len(hit)} hits, {len(missing)} misses.")
+    if stats is not None:
+        stats.add("embeddings", len(missing))
+        stats.add("embed_cache_hits", len(hit))
+    cached = cache.get(rows[hit]) if len(hit) else None
+    fresh = None
+    if len(missing):
+        miss_texts = [texts[i] for i in missing]
+        if progress:
+            fresh = l2_normalize(client.embed_many(miss_texts, EMBED_MODEL, progress=progress))
+        else:
+            with tqdm(total=len(missing)) as bar:
+                fresh = l2_normalize(client.embed_many(miss_texts, EMBED_MODEL, progress=bar.update))
+        cache.put([keys[i] for i in missing], fresh)
+    if progress and len(hit):
+        progress(len(hit))
+    if own_cache:
+        cache.save()
+
+    vecs = np.empty((len(texts), cache.dim), dtype="float32")
+    if cached is not None:
+        vecs[hit] = cached
+    if fresh is not None:
+        vecs[missing] = fresh
+    return l2_normalize(vecs)
+
+def ingest_config() -> Dict:
+    return {
+        "embedding_model": EMBED_MODEL,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "ocr_mode": OCR_MODE,
+        "ocr_langs": OCR_LANGS,
+    }
+
+class Staging:
+    def __init__(self, root: Path = STAGING_DIR):
+        self.root = root
+        self.chunks_path = root / "chunks.jsonl"
+        self.vectors_path = root / "vectors.f32"
+        self.checkpoint_path = root / "checkpoint.json"
+        self.state: Dict = {}
+
+    def open(self, config: Dict, fingerprints: Dict[str, Dict]) -> None:
+        state = {}
+        if self.checkpoint_path.exists():
+            try:
+                state = json.loads(self.checkpoint_path.read_text(encoding="utf-8"))
+            except Exception:
+                state = {}
+        stale = any(fingerprints.get(path) != fp for path, fp in state.get("done", {}).items())
+        if state and not self._files_intact(state):
+            print("WARN: staged files do not match the ingest checkpoint; starting over.")
+            stale = True
+        if state.get("config") != config or stale:
+            if self.root.exists():
+                shutil.rmtree(self.root)
+            state = {"config": config, "done": {}, "rows": 0, "chunk_bytes": 0, "dim": 0}
+        self.root.mkdir(parents=True, exist_ok=True)
+        for path, size in ((self.chunks_path, state["chunk_bytes"]), (self.vectors_path, state["rows"] * state["dim"] * 4)):
+            with open(path, "ab") as f:
+                f.truncate(size)
+        self.state = state
+
+    def _files_intact(self, state: Dict) -> bool:
+        # the checkpoint only vouches for bytes that are still on disk
+        try:
+            return (self.chunks_path.stat().st_size >= state["chunk_bytes"]
+                    and self.vectors_path.stat().st_size >= state["rows"] * state["dim"] * 4)
+        except (OSError, KeyError, TypeError):
+            return False
+
+    def release(self) -> None:
+        """Invalidate the checkpoint before staged files are moved into a generation."""
+        self.checkpoint_path.unlink(missing_ok=True)
+
+    def is_done(self, pdf: Path, fingerprint: Dict) -> bool:
+        return self.state["done"].get(str(pdf)) == fingerprint
+
+    def commit(self, pdf: Path, fingerprint: Dict, texts: List[str], metas: List[Dict], vecs: np.ndarray) -> None:
+        if len(texts):
+            if not self.state["dim"]:
+                self.state["dim"] = int(vecs.shape[1])
+            with open(self.chunks_path, "ab") as f:
+                for meta, text in zip(metas, texts):
+                    rec = {"uid": make_uid(meta, text), "meta": meta, "text": text}
+                    f.write((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+                self.state["chunk_bytes"] = f.tell()
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(vecs, dtype="float32").tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.state["rows"] += len(texts)
+        self.state["done"][str(pdf)] = fingerprint
+        tmp = self.root / "checkpoint.json.tmp"
+        tmp.write_text(json.dumps(self.state), encoding="utf-8")
+        os.replace(tmp, self.checkpoint_path)
+
+    def vectors(self) -> np.ndarray:
+        return np.memmap(self.vectors_path, dtype="float32", mode="r", shape=(self.state["rows"], self.state["dim"]))
+
+    def texts(self):
+        with open(self.chunks_path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)["text"]
+
+def _init_extract_worker(ocr_workers: int) -> None:
+    import app.ocr
+    app.ocr.OCR_WORKERS = ocr_workers
+
+def extract_job(pdf: Path) -> tuple[Path, list[str], list[dict], Throughput]:
+    stats = Throughput()
+    with stats.timed("extract"):
+        texts, metas = extract_chunks(pdf, stats)
+    return pdf, texts, metas, stats
+
+def iter_extracted(pdfs: List[Path], workers: int = INGEST_WORKERS):
+    if workers <= 1 or len(pdfs) <= 1:
+        for pdf in pdfs:
+            yield extract_job(pdf)
+        return
+    ocr_workers = max(1, (os.cpu_count() or 1) // workers)
+    max_inflight = workers * 2
+    queue = list(pdfs)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_extract_worker, initargs=(ocr_workers,)) as pool:
+        inflight = set()
+        while queue or inflight:
+            while queue and len(inflight) < max_inflight:
+                inflight.add(pool.submit(extract_job, queue.pop(0)))
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                yield fut.result()
+
 def main():
-    import numpy as np, faiss
     client = OllamaClient()
     if not client.is_alive():
         raise SystemExit("Ollama is not reachable. Ensure it's running and OLLAMA_HOST is correct.")
 
     print(f"Using OCR mode: {OCR_MODE} (langs={OCR_LANGS})")
-    print("Building corpus from PDFs...")
-    texts, metas = build_corpus()
+    pdfs = list_pdfs()
+    fingerprints = {str(pdf): file_fingerprint(pdf) for pdf in pdfs}
+    staging = Staging()
+    staging.open(ingest_config(), fingerprints)
+    todo = [pdf for pdf in pdfs if not staging.is_done(pdf, fingerprints[str(pdf)])]
+    if len(todo) < len(pdfs):
+        print(f"Resuming interrupted ingest: {len(pdfs) - len(todo)} PDF(s) already done, {staging.state['rows']} chunks staged.")
 
-    print(f"Embedding {len(texts)} chunks with '{EMBED_MODEL}' via Ollama...")
-    from tqdm import tqdm
-    vecs_list = []
-    for t in tqdm(texts):
-        vecs_list.append(client.embed(t, EMBED_MODEL))
-    vecs = np.array(vecs_list, dtype="float32")
-    vecs = l2_normalize(vecs)
+    print(f"Extracting {len(todo)} PDF(s) with {min(INGEST_WORKERS, max(len(todo), 1))} worker(s) and embedding with '{EMBED_MODEL}'...")
+    cache = EmbeddingCache(EMBED_MODEL) if EMBED_CACHE else None
+    stats = Throughput()
+    try:
+        with tqdm(total=len(todo), unit="pdf", position=0) as pdf_bar, tqdm(unit="chunk", position=1) as chunk_bar:
+            for pdf, texts, metas, pdf_stats in iter_extracted(todo):
+                stats.merge(pdf_stats)
+                stats.add("chunks", len(texts))
+                vecs = np.zeros((0, 0), dtype="float32")
+                if texts:
+                    vecs = embed_texts(client, texts, cache=cache, progress=chunk_bar.update, stats=stats)
+                staging.commit(pdf, fingerprints[str(pdf)], texts, metas, vecs)
+                if cache is not None:
+                    cache.save()
+                pdf_bar.update(1)
+    finally:
+        if cache is not None:
+            cache.save()
 
-    dim = vecs.shape[1]
-    index = faiss.IndexFlatIP(dim) 
-    index.add(vecs)
-
-    faiss.write_index(index, str(STORE_DIR / "index.faiss"))
+    if not staging.state["rows"]:
+        raise SystemExit("No extractable text found in PDFs (even after OCR).")
 
-    with open(STORE_DIR / "chunks.jsonl", "w", encoding="utf-8") as f:
-        for meta, text in zip(metas, texts):
-            uid = make_uid(meta, text)
-            rec = {"uid": uid, "meta": meta, "text": text}
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    vecs = staging.vectors()
+    index_cfg = index_config(vecs.shape[0], vecs.shape[1])
+    gen_dir = new_generation()
+    print(f"Building '{index_cfg['type']}' index over {vecs.shape[0]} vectors...")
+    with stats.timed("index"):
+        index = build_index(vecs, index_cfg)
+        save_index(index, gen_dir / INDEX_FILE)
+    print(f"Index storage '{index_cfg['storage']}': {(gen_dir / INDEX_FILE).stat().st_size / 2**20:.1f} MB "
+          f"({bytes_per_vector(index_cfg, vecs.shape[1]):g} bytes/vector)")
+    with stats.timed("bm25"):
+        BM25Index.build(staging.texts()).save(gen_dir / BM25_FILE)
+    staging.release()
+    os.replace(staging.chunks_path, gen_dir / CHUNKS_FILE)
+    if index_cfg["rescore"]:
+        os.replace(staging.vectors_path, gen_dir / VECTORS_FILE)
+    ensure_offsets(gen_dir / CHUNKS_FILE)
+    DocMap.from_chunks(gen_dir / CHUNKS_FILE).save(gen_dir / DOCS_FILE)
+    save_fingerprints(staging.state["done"], gen_dir)
 
     manifest = {
-        "embedding_model": EMBED_MODEL,
-        "chunk_size": CHUNK_SIZE,
-        "chunk_overlap": CHUNK_OVERLAP,
+        **ingest_config(),
         "vector_count": int(vecs.shape[0]),
         "vector_dim": int(vecs.shape[1]),
-        "ocr_mode": OCR_MODE,
-        "ocr_langs": OCR_LANGS,
+        "index": index_cfg,
+        "ingest_stats": stats.report(),
     }
-    with open(STORE_DIR / "manifest.json", "w", encoding="utf-8") as f:
-        json.dump(manifest, f, indent=2)
+    del vecs
+    manifest = write_manifest(manifest, gen_dir)
+    publish(gen_dir)
+    shutil.rmtree(staging.root, ignore_errors=True)
 
-    print("\n✅ Ingestion complete. Index saved to ./store")
+    print(f"\n{stats.summary()}")
+    print(f"✅ Ingestion complete. Published generation {manifest['generation']} in {gen_dir}")
 
 if __name__ == "__main__":
     main()
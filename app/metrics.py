@@ -0,0 +1,171 @@
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    parts = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{n}="{v}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = STAGE_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, n) in sorted(self._series.items()):
+                names = self.labelnames + ("le",)
+                for bound, c in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_fmt_labels(names, key + (f'{bound:g}',))} {c}")
+                lines.append(f"{self.name}_bucket{_fmt_labels(names, key + ('+Inf',))} {n}")
+                lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {total:g}")
+                lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {n}")
+        return lines
+
+
+stage_seconds = Histogram("pdfqa_stage_seconds", "Time spent in each query pipeline stage.", ("stage",))
+ask_seconds = Histogram("pdfqa_ask_seconds", "End-to-end /ask latency.", ("mode", "cached"))
+llm_tokens = Counter("pdfqa_llm_tokens_total", "Tokens reported by Ollama.", ("model", "kind"))
+llm_generation_rate = Histogram("pdfqa_llm_generation_tokens_per_second", "Generation speed reported by Ollama.",
+                                ("model",), RATE_BUCKETS)
+model_loads = Counter("pdfqa_model_loads_total", "Models admitted by the scheduler without being resident.", ("model",))
+REGISTRY = [stage_seconds, ask_seconds, llm_tokens, llm_generation_rate, model_loads]
+
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("pdfqa_timings", default=None)
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+@contextmanager
+def collect_timings() -> Iterator[Dict[str, float]]:
+    """Collect per-stage seconds for everything run in this context (tasks and to_thread calls inherit it).
+
+    Nested collections also add their stages to the enclosing one on exit.
+    """
+    timings: Dict[str, float] = {}
+    outer = _timings.get()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+        if outer is not None:
+            for stage, seconds in timings.items():
+                outer[stage] = outer.get(stage, 0.0) + seconds
+
+
+def record(stage: str, seconds: float) -> None:
+    stage_seconds.observe(seconds, stage=stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def record_ollama(model: str, data: Dict) -> None:
+    """Record the load/prompt-eval/generation split from a final Ollama chat response (durations are in ns)."""
+    for field, stage in (("load_duration", "llm_load"), ("prompt_eval_duration", "llm_prompt_eval"), ("eval_duration", "llm_generate")):
+        if data.get(field):
+            record(stage, data[field] / 1e9)
+    if data.get("prompt_eval_count"):
+        llm_tokens.inc(data["prompt_eval_count"], model=model, kind="prompt")
+    if data.get("eval_count"):
+        llm_tokens.inc(data["eval_count"], model=model, kind="generated")
+        if data.get("eval_duration"):
+            llm_generation_rate.observe(data["eval_count"] / (data["eval_duration"] / 1e9), model=model)
+
+
+class Throughput:
+    """Counts and stage seconds for a batch job such as ingest, reported as rates."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.counts: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+
+    def add(self, name: str, n: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def merge(self, other: "Throughput") -> None:
+        for name, n in other.counts.items():
+            self.add(name, n)
+        for stage, sec in other.seconds.items():
+            self.add_time(stage, sec)
+
+    def report(self) -> Dict:
+        wall = time.perf_counter() - self.started
+        out = {"wall_s": round(wall, 3), **self.counts}
+        out.update({f"{name}_per_s": round(n / wall, 2) if wall > 0 else 0.0 for name, n in self.counts.items()})
+        out.update({f"{stage}_s": round(s, 3) for stage, s in self.seconds.items()})
+        return out
+
+    def summary(self) -> str:
+        r = self.report()
+        rates = ", ".join(f"{r[name + '_per_s']} {name.replace('_', ' ')}/s" for name in self.counts)
+        stages = ", ".join(f"{stage} {sec:.1f}s" for stage, sec in self.seconds.items())
+        return f"Throughput: {rates} over {r['wall_s']:.1f}s" + (f" ({stages})" if stages else "")
@@ -1,25 +1,69 @@
 import os
+import re
 import shutil
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
-from PIL import Image
-from pdf2image import convert_from_path
-import pytesseract
+from app.utils.hash_utils import file_sha1
+
+OCR_CACHE_DIR = Path(os.getenv("OCR_CACHE_DIR", "cache/ocr"))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", 0)) or (os.cpu_count() or 1)
 
 def page_needs_ocr(text: str, threshold_chars: int = 40) -> bool:
     return len(text.strip()) < threshold_chars
 
-def ocr_with_pytesseract(pdf_path: Path, dpi: int = 300, lang: str = "eng") -> List[str]:
-    pages_text: List[str] = []
-    images = convert_from_path(str(pdf_path), dpi=dpi)
-    for img in images:
-        if img.mode != "RGB":
-            img = img.convert("RGB")
-        txt = pytesseract.image_to_string(img, lang=lang)
-        pages_text.append(txt or "")
-    return pages_text
+def ocr_page(pdf_path: Path, page: int, dpi: int = 300, lang: str = "eng") -> str:
+    # OCR libraries are only loaded once a page actually needs OCR
+    from pdf2image import convert_from_path
+    import pytesseract
+    images = convert_from_path(str(pdf_path), dpi=dpi, first_page=page, last_page=page)
+    if not images:
+        return ""
+    img = images[0]
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return pytesseract.image_to_string(img, lang=lang) or ""
+
+def _ocr_page_job(args) -> str:
+    return ocr_page(*args)
+
+def _cache_path(pdf_hash: str, page: int, dpi: int, lang: str) -> Path:
+    return OCR_CACHE_DIR / pdf_hash / f"p{page}-{dpi}dpi-{re.sub(r'[^A-Za-z0-9]+', '_', lang)}.txt"
+
+def ocr_pages(pdf_path: Path, pages: List[int], dpi: int = 300, lang: str = "eng", pdf_hash: str | None = None) -> Dict[int, str]:
+    pdf_hash = pdf_hash or file_sha1(pdf_path)
+    out: Dict[int, str] = {}
+    todo: List[int] = []
+    for page in pages:
+        cached = _cache_path(pdf_hash, page, dpi, lang)
+        if cached.exists():
+            out[page] = cached.read_text(encoding="utf-8")
+        else:
+            todo.append(page)
+    if not todo:
+        return out
+
+    jobs = [(pdf_path, page, dpi, lang) for page in todo]
+    workers = min(OCR_WORKERS, len(todo))
+    if workers <= 1:
+        texts = [_ocr_page_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            texts = list(pool.map(_ocr_page_job, jobs))
+
+    (OCR_CACHE_DIR / pdf_hash).mkdir(parents=True, exist_ok=True)
+    for page, txt in zip(todo, texts):
+        _cache_path(pdf_hash, page, dpi, lang).write_text(txt, encoding="utf-8")
+        out[page] = txt
+    return out
+
+def ocr_with_pytesseract(pdf_path: Path, dpi: int = 300, lang: str = "eng", pdf_hash: str | None = None) -> List[str]:
+    from pdf2image import pdfinfo_from_path
+    n_pages = int(pdfinfo_from_path(str(pdf_path))["Pages"])
+    texts = ocr_pages(pdf_path, list(range(1, n_pages + 1)), dpi=dpi, lang=lang, pdf_hash=pdf_hash)
+    return [texts[p] for p in range(1, n_pages + 1)]
 
 def ocrmypdf_available() -> bool:
     return shutil.which("ocrmypdf") is not None
@@ -1,30 +1,26 @@
 import os
-import re
-import json
-from pathlib import Path
-from typing import List, Dict, Tuple
+import asyncio
+from dataclasses import dataclass
+from typing import List, Dict, Tuple, Iterator, AsyncIterator, Optional
 
-import faiss
 import numpy as np
-from dotenv import load_dotenv
 
-from app.utils.ollama_client import OllamaClient
+from app.utils.ollama_client import OllamaClient, get_client
+from app.store import get_store
+from app.answer_cache import answer_cache
+from app.embed_cache import query_embeddings
+from app.metrics import timed
+from app.vector_index import rescore, subset_search, FILTER_SCAN_LIMIT
+from app.doc_map import filters_key, row_ranges
+from app.context_packer import pack_context, context_budget, estimate_tokens, block_label, NUM_CTX
 
-load_dotenv()
-
-STORE_DIR = Path("store")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
 LLM_MODEL = os.getenv("LLM_MODEL", "llama3.1:8b")
 TOP_K = int(os.getenv("TOP_K", 5))
-
-
-def load_index_and_chunks():
-    index = faiss.read_index(str(STORE_DIR / "index.faiss"))
-    chunks: list[Dict] = []
-    with open(STORE_DIR / "chunks.jsonl", "r", encoding="utf-8") as f:
-        for line in f:
-            chunks.append(json.loads(line))
-    return index, chunks
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid").lower()
+HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", 0.75))
+RRF_K = 60
+CAND_MULT = 6
 
 
 def l2_normalize(x: np.ndarray) -> np.ndarray:
@@ -33,78 +29,313 @@ def l2_normalize(x: np.ndarray) -> np.ndarray:
     return x / norms
 
 
-def retrieve(question: str, client: OllamaClient, k: int = TOP_K) -> Tuple[List[Dict], List[int]]:
-    qv = np.array([client.embed(question, EMBED_MODEL)], dtype="float32")
-    qv = l2_normalize(qv)
-    index, chunks = load_index_and_chunks()
-    CAND_MULT = 6
-    sims, idxs = index.search(qv, k * CAND_MULT)
-    idxs = idxs[0].tolist()
-    faiss_scores = sims[0].tolist()
-    tokens = re.findall(r"\w+", question.lower())
-    def kw_score(text: str):
-        t = text.lower()
-        return sum(t.count(tok) for tok in tokens if len(tok) > 2)
-
-    candidates = []
-    for i, s in zip(idxs, faiss_scores):
-        rec = chunks[i]
-        score = 0.75 * float(s) + 0.25 * float(kw_score(rec["text"])) 
-        candidates.append((score, rec, i))
-
-    candidates.sort(key=lambda x: x[0], reverse=True)
-    top = candidates[:k]
-    items = [rec for _, rec, _ in top]
-    final_idxs = [i for _, _, i in top]
+def embed_query(question: str, client: OllamaClient) -> np.ndarray:
+    qv = query_embeddings.get(EMBED_MODEL, question)
+    if qv is None:
+        qv = l2_normalize(np.array([client.embed(question, EMBED_MODEL)], dtype="float32"))
+        query_embeddings.put(EMBED_MODEL, question, qv)
+    return qv
+
+
+def embed_queries(questions: List[str], client: OllamaClient) -> np.ndarray:
+    rows = [query_embeddings.get(EMBED_MODEL, q) for q in questions]
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        vecs = l2_normalize(client.embed_many([questions[i] for i in missing], EMBED_MODEL))
+        for i, vec in zip(missing, vecs):
+            rows[i] = vec.reshape(1, -1)
+            query_embeddings.put(EMBED_MODEL, questions[i], vec)
+    return np.vstack(rows)
+
+
+async def aembed_query(question: str, client: OllamaClient) -> np.ndarray:
+    qv = query_embeddings.get(EMBED_MODEL, question)
+    if qv is None:
+        qv = l2_normalize(np.array([await client.aembed(question, EMBED_MODEL)], dtype="float32"))
+        query_embeddings.put(EMBED_MODEL, question, qv)
+    return qv
+
+
+def retrieve(question: str, client: OllamaClient, k: int = TOP_K, qv: Optional[np.ndarray] = None) -> Tuple[List[Dict], List[int]]:
+    if qv is None:
+        qv = embed_query(question, client)
+    return search(question, qv, k)
+
+
+@dataclass
+class Retrieval:
+    """Embedding, search hits and packed prompt for one question, computed once and shared by every generation."""
+    question: str
+    k: int
+    qv: np.ndarray
+    chunks: List[Dict]
+    ids: List[int]
+    messages: List[Dict]
+    sources: List[Dict]
+    context: Dict
+    filters: Optional[Dict] = None
+
+    def result(self, answer: str, **extra) -> dict:
+        return {"answer": answer, "sources": self.sources, "context": self.context, **extra}
+
+    def sources_event(self) -> dict:
+        return {"type": "sources", "sources": self.sources, "context": self.context}
+
+    @property
+    def no_match(self) -> bool:
+        """The filters left nothing to search, so there is no context worth sending to a model."""
+        return bool(self.filters) and not self.chunks
+
+
+def build_retrieval(question: str, k: int, qv: np.ndarray, chunks: List[Dict], ids: List[int],
+                    filters: Optional[Dict] = None) -> Retrieval:
+    messages, sources, context = make_prompt(question, chunks)
+    return Retrieval(question, k, qv, chunks, ids, messages, sources, context, filters)
+
+
+def prepare(question: str, client: OllamaClient, k: int = TOP_K, qv: Optional[np.ndarray] = None,
+            filters: Optional[Dict] = None) -> Retrieval:
+    if qv is None:
+        qv = embed_query(question, client)
+    return build_retrieval(question, k, qv, *search(question, qv, k, filters), filters)
+
+
+async def aprepare(question: str, client: OllamaClient, k: int = TOP_K, qv: Optional[np.ndarray] = None,
+                   filters: Optional[Dict] = None) -> Retrieval:
+    if qv is None:
+        qv = await aembed_query(question, client)
+    chunks, ids = await asyncio.to_thread(search, question, qv, k, filters)
+    return build_retrieval(question, k, qv, chunks, ids, filters)
+
+
+def answer_scope(mode: str, k: int, models: List[str], judge_model: Optional[str] = None,
+                 filters: Optional[Dict] = None) -> tuple:
+    return (get_store().generation, mode, tuple(models), judge_model, k, filters_key(filters))
+
+
+def lookup_answer(scope: tuple, question: str, client: OllamaClient,
+                  qv: Optional[np.ndarray] = None) -> Tuple[Optional[dict], Optional[np.ndarray]]:
+    hit = answer_cache.get(scope, question)
+    if hit is not None:
+        return hit, qv
+    if qv is None:
+        qv = embed_query(question, client)
+    return answer_cache.get_similar(scope, qv), qv
+
+
+async def alookup_answer(scope: tuple, question: str, client: OllamaClient,
+                         qv: Optional[np.ndarray] = None) -> Tuple[Optional[dict], Optional[np.ndarray]]:
+    hit = answer_cache.get(scope, question)
+    if hit is not None:
+        return hit, qv
+    if qv is None:
+        qv = await aembed_query(question, client)
+    return answer_cache.get_similar(scope, qv), qv
+
+
+def replay_answer(hit: dict) -> Iterator[dict]:
+    yield {"type": "sources", "sources": hit["sources"], "context": hit.get("context")}
+    if hit.get("candidates") is not None:
+        yield {"type": "candidates", "candidates": hit["candidates"]}
+    yield {"type": "token", "content": hit["answer"]}
+    done = {"type": "done", "model": hit.get("judge_model") or hit.get("model"), "cached": hit["cached"]}
+    if "judge_ran" in hit:
+        done["judge_ran"] = hit["judge_ran"]
+    yield done
+
+
+def search(question: str, qv: np.ndarray, k: int = TOP_K, filters: Optional[Dict] = None) -> Tuple[List[Dict], List[int]]:
+    return search_many([question], qv, k, filters)[0]
+
+
+def search_many(questions: List[str], qvs: np.ndarray, k: int = TOP_K,
+                filters: Optional[Dict] = None) -> List[Tuple[List[Dict], List[int]]]:
+    qvs = l2_normalize(np.asarray(qvs, dtype="float32").reshape(len(questions), -1))
+    store = get_store()
+    n_cand = k * CAND_MULT
+    if filters:
+        # only the matching rows are scored, so a narrower filter means less work
+        with timed("filter_rows"):
+            rows = store.filter_rows(filters)
+        n_fetch = min(len(rows), n_cand)
+        with timed("dense_search"):
+            idxs = subset_search(store.index, qvs, rows, n_fetch, store.vectors)
+        if store.vectors is not None and len(rows) > FILTER_SCAN_LIMIT:
+            with timed("rescore"):
+                idxs = rescore(store.vectors, qvs, idxs)
+        ranges = row_ranges(rows)
+    else:
+        n_fetch = min(store.index.ntotal, n_cand + min(len(store.dead), 2 * n_cand))
+        with timed("dense_search"):
+            _, idxs = store.index.search(qvs, n_fetch)
+        if store.vectors is not None:
+            with timed("rescore"):
+                idxs = rescore(store.vectors, qvs, idxs)
+        ranges = None
+    return [_rank(store, question, row, k, n_cand, n_fetch, ranges) for question, row in zip(questions, idxs)]
+
+
+def _rank(store, question: str, dense_row: np.ndarray, k: int, n_cand: int, n_fetch: int,
+          ranges: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> Tuple[List[Dict], List[int]]:
+    dense = [i for i in dense_row.tolist() if i >= 0 and i not in store.dead][:n_cand]
+
+    if RETRIEVAL_MODE == "dense" or store.bm25 is None:
+        final_idxs = dense[:k]
+    elif n_fetch == 0:
+        final_idxs = []
+    else:
+        with timed("keyword_search"):
+            sparse, _ = store.bm25.search(question, n_fetch, ranges)
+        sparse = [i for i in sparse.tolist() if i not in store.dead][:n_cand]
+        fused: Dict[int, float] = {}
+        for rank, i in enumerate(dense):
+            fused[i] = fused.get(i, 0.0) + HYBRID_ALPHA / (RRF_K + rank + 1)
+        for rank, i in enumerate(sparse):
+            fused[i] = fused.get(i, 0.0) + (1.0 - HYBRID_ALPHA) / (RRF_K + rank + 1)
+        final_idxs = sorted(fused, key=fused.get, reverse=True)[:k]
+
+    with timed("fetch_chunks"):
+        items = store.chunks.get_many(final_idxs)
     return items, final_idxs
 
 
-def make_prompt(question: str, retrieved: List[Dict]) -> Tuple[list[dict], list[dict]]:
-    ctx_lines = []
-    sources = []
-    for i, rec in enumerate(retrieved, start=1):
-        meta = rec["meta"]
-        text = (rec["text"] or "").strip()
-        src_label = f"[{i}] {meta['doc']} p.{meta['page']}"
-        ctx_lines.append(f"{src_label}:\n{text}")
-        sources.append({
-            "n": i,
-            "doc": meta["doc"],
-            "page": meta["page"],
-            "path": meta.get("path", ""),
-            "snippet": (text[:320] + ("…" if len(text) > 320 else "")),
-        })
-
-    system = '''You are a helpful assistant. Use ONLY the provided context to answer.
-If the needed info is not present in the context, respond EXACTLY with: "I don't know from these PDFs."
+REFUSAL = "I don't know from these PDFs."
+NO_MATCH = "No documents match these filters."
+SYSTEM_PROMPT = f'''You are a helpful assistant. Use ONLY the provided context to answer.
+If the needed info is not present in the context, respond EXACTLY with: "{REFUSAL}"
 Do not include outside knowledge or guesses.'''
 
-    user = (
-        f"Question: {question}\n\n"
-        f"Context blocks:\n\n" + "\n\n".join(ctx_lines)
-    )
 
-    messages = [
-        {"role": "system", "content": system},
-        {"role": "user", "content": user},
-    ]
-    return messages, sources
+def make_prompt(question: str, retrieved: List[Dict]) -> Tuple[list[dict], list[dict], dict]:
+    with timed("prompt_build"):
+        head = f"Question: {question}\n\nContext blocks:\n\n"
+        blocks, stats = pack_context(retrieved, context_budget(SYSTEM_PROMPT + head))
+        ctx_lines = []
+        sources = []
+        for b in blocks:
+            text = b["text"]
+            ctx_lines.append(block_label(b["n"], b["doc"], b["page"]) + text)
+            sources.append({
+                "n": b["n"],
+                "doc": b["doc"],
+                "page": b["page"],
+                "path": b["path"],
+                "snippet": (text[:320] + ("…" if len(text) > 320 else "")),
+            })
+
+        user = head + "\n\n".join(ctx_lines)
+        stats["prompt_tokens"] = estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(user)
+        stats["num_ctx"] = NUM_CTX
+
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user},
+        ]
+        return messages, sources, stats
+
+
+def no_match_events(r: Retrieval, **done) -> Iterator[dict]:
+    yield r.sources_event()
+    yield {"type": "token", "content": NO_MATCH}
+    yield {"type": "done", **done}
+
 
+def ask(question: str, k: int = TOP_K, model: str = None, retrieval: Optional[Retrieval] = None,
+        filters: Optional[Dict] = None) -> dict:
+    model = model or LLM_MODEL
+    if retrieval is not None:
+        question, k, filters = retrieval.question, retrieval.k, retrieval.filters
+    client = get_client()
+    scope = answer_scope("single", k, [model], filters=filters)
+    hit, qv = lookup_answer(scope, question, client, retrieval.qv if retrieval else None)
+    if hit is not None:
+        return hit
+    r = retrieval or prepare(question, client, k, qv, filters)
+    if r.no_match:
+        return r.result(NO_MATCH, model=model)
+    out = r.result(client.chat(model=model, messages=r.messages), model=model)
+    answer_cache.put(scope, question, r.qv, out)
+    return out
 
-def ask(question: str, k: int = TOP_K) -> dict:
-    client = OllamaClient()
-    retrieved, idxs = retrieve(question, client, k=k)
-    messages, sources = make_prompt(question, retrieved)
-    answer = client.chat(model=LLM_MODEL, messages=messages)
-    return {"answer": answer, "sources": sources}
+
+async def aask(question: str, k: int = TOP_K, model: str = None, retrieval: Optional[Retrieval] = None,
+               filters: Optional[Dict] = None) -> dict:
+    model = model or LLM_MODEL
+    if retrieval is not None:
+        question, k, filters = retrieval.question, retrieval.k, retrieval.filters
+    client = get_client()
+    scope = await asyncio.to_thread(answer_scope, "single", k, [model], None, filters)
+    hit, qv = await alookup_answer(scope, question, client, retrieval.qv if retrieval else None)
+    if hit is not None:
+        return hit
+    r = retrieval or await aprepare(question, client, k, qv, filters)
+    if r.no_match:
+        return r.result(NO_MATCH, model=model)
+    out = r.result(await client.achat(model=model, messages=r.messages), model=model)
+    answer_cache.put(scope, question, r.qv, out)
+    return out
+
+
+def ask_stream(question: str, k: int = TOP_K, model: str = None, retrieval: Optional[Retrieval] = None,
+               filters: Optional[Dict] = None) -> Iterator[dict]:
+    model = model or LLM_MODEL
+    if retrieval is not None:
+        question, k, filters = retrieval.question, retrieval.k, retrieval.filters
+    client = get_client()
+    scope = answer_scope("single", k, [model], filters=filters)
+    hit, qv = lookup_answer(scope, question, client, retrieval.qv if retrieval else None)
+    if hit is not None:
+        yield from replay_answer(hit)
+        return
+    r = retrieval or prepare(question, client, k, qv, filters)
+    if r.no_match:
+        yield from no_match_events(r, model=model)
+        return
+    yield r.sources_event()
+    pieces = []
+    for piece in client.chat_stream(model=model, messages=r.messages):
+        pieces.append(piece)
+        yield {"type": "token", "content": piece}
+    answer_cache.put(scope, question, r.qv, r.result("".join(pieces), model=model))
+    yield {"type": "done", "model": model}
+
+
+async def aask_stream(question: str, k: int = TOP_K, model: str = None, retrieval: Optional[Retrieval] = None,
+                      filters: Optional[Dict] = None) -> AsyncIterator[dict]:
+    model = model or LLM_MODEL
+    if retrieval is not None:
+        question, k, filters = retrieval.question, retrieval.k, retrieval.filters
+    client = get_client()
+    scope = await asyncio.to_thread(answer_scope, "single", k, [model], None, filters)
+    hit, qv = await alookup_answer(scope, question, client, retrieval.qv if retrieval else None)
+    if hit is not None:
+        for ev in replay_answer(hit):
+            yield ev
+        return
+    r = retrieval or await aprepare(question, client, k, qv, filters)
+    if r.no_match:
+        for ev in no_match_events(r, model=model):
+            yield ev
+        return
+    yield r.sources_event()
+    pieces = []
+    async for piece in client.achat_stream(model=model, messages=r.messages):
+        pieces.append(piece)
+        yield {"type": "token", "content": piece}
+    answer_cache.put(scope, question, r.qv, r.result("".join(pieces), model=model))
+    yield {"type": "done", "model": model}
 
 
 if __name__ == "__main__":
     import sys
     q = " ".join(sys.argv[1:]) or "What are the key ideas across these PDFs?"
-    out = ask(q)
+    sources = []
     print("\n=== Answer ===\n")
-    print(out["answer"]) 
-    print("\nSources:")
-    for s in out["sources"]:
+    for ev in ask_stream(q):
+        if ev["type"] == "sources":
+            sources = ev["sources"]
+        elif ev["type"] == "token":
+            print(ev["content"], end="", flush=True)
+    print("\n\nSources:")
+    for s in sources:
         print(f"[{s['n']}] {s['doc']} p.{s['page']}")
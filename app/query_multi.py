@@ -1,18 +1,47 @@
 import os
-from typing import List, Dict, Tuple
+import time
+import asyncio
+import threading
+import re
+import contextvars
+from dataclasses import dataclass
+from concurrent.futures import CancelledError, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, List, Dict, Tuple, Iterator, AsyncIterator, Optional
 
-from app.utils.ollama_client import OllamaClient
-from app.query import retrieve, make_prompt, TOP_K
+from app.utils.ollama_client import OllamaClient, get_client
+from app.query import (Retrieval, prepare, aprepare, ask, aask, ask_stream, aask_stream, answer_scope,
+                       lookup_answer, alookup_answer, replay_answer, no_match_events, l2_normalize, EMBED_MODEL,
+                       REFUSAL, NO_MATCH, TOP_K)
+from app.answer_cache import answer_cache
+from app.metrics import timed, collect_timings
 
 LLM_MODELS = [m.strip() for m in os.getenv("LLM_MODELS", "llama3.1:8b").split(",") if m.strip()]
 JUDGE_MODEL = os.getenv("JUDGE_MODEL", "llama3.1:8b")
+CONSENSUS_TIMEOUT = float(os.getenv("CONSENSUS_TIMEOUT", 300))
+CONSENSUS_CONCURRENCY = int(os.getenv("CONSENSUS_CONCURRENCY", 3))
+CONSENSUS_QUORUM = int(os.getenv("CONSENSUS_QUORUM", 0))
+CONSENSUS_AGREEMENT = float(os.getenv("CONSENSUS_AGREEMENT", 0.92))
+JUDGE_PROMPT = os.getenv("JUDGE_PROMPT", "full").lower()
 
-def ask_with_model(question: str, model: str, k: int = TOP_K) -> dict:
-    client = OllamaClient()
-    retrieved, _ = retrieve(question, client, k=k)
-    messages, sources = make_prompt(question, retrieved)
-    answer = client.chat(model=model, messages=messages)
-    return {"answer": answer, "sources": sources, "model": model}
+def ask_with_model(question: str, model: str, k: int = TOP_K, retrieval: Optional[Retrieval] = None,
+                   filters: Optional[Dict] = None) -> dict:
+    return ask(question, k, model=model, retrieval=retrieval, filters=filters)
+
+async def aask_with_model(question: str, model: str, k: int = TOP_K, retrieval: Optional[Retrieval] = None,
+                          filters: Optional[Dict] = None) -> dict:
+    return await aask(question, k, model=model, retrieval=retrieval, filters=filters)
+
+def ask_models(question: str, models: List[str], k: int = TOP_K, concurrency: int = CONSENSUS_CONCURRENCY,
+               filters: Optional[Dict] = None) -> List[dict]:
+    """Answer with each model side by side; embedding and search run once for all of them."""
+    r = prepare(question, get_client(), k, filters=filters)
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(models)))) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, ask_with_model, question, m, k, r) for m in models]
+        return [f.result() for f in futures]
+
+async def aask_models(question: str, models: List[str], k: int = TOP_K, filters: Optional[Dict] = None) -> List[dict]:
+    r = await aprepare(question, get_client(), k, filters=filters)
+    return list(await asyncio.gather(*(aask_with_model(question, m, k, r) for m in models)))
 
 def route_model(question: str, models: List[str] = None) -> str:
     models = models or LLM_MODELS
@@ -23,35 +52,353 @@ def route_model(question: str, models: List[str] = None) -> str:
         return models[1]
     return models[0]
 
-def ask_router(question: str, k: int = TOP_K, models: List[str] = None) -> dict:
+def ask_router(question: str, k: int = TOP_K, models: List[str] = None, filters: Optional[Dict] = None) -> dict:
     model = route_model(question, models)
-    return ask_with_model(question, model, k)
+    return ask_with_model(question, model, k, filters=filters)
 
-def ask_consensus(question: str, k: int = TOP_K, models: List[str] = None, judge_model: str = None) -> dict:
-    models = models or LLM_MODELS[:3]
-    judge_model = judge_model or JUDGE_MODEL
-    client = OllamaClient()
-    retrieved, _ = retrieve(question, client, k=k)
-    messages, sources = make_prompt(question, retrieved)
+async def aask_router(question: str, k: int = TOP_K, models: List[str] = None, filters: Optional[Dict] = None) -> dict:
+    model = route_model(question, models)
+    return await aask_with_model(question, model, k, filters=filters)
+
+def ask_router_stream(question: str, k: int = TOP_K, models: List[str] = None, filters: Optional[Dict] = None) -> Iterator[dict]:
+    return ask_stream(question, k, model=route_model(question, models), filters=filters)
+
+def aask_router_stream(question: str, k: int = TOP_K, models: List[str] = None,
+                       filters: Optional[Dict] = None) -> AsyncIterator[dict]:
+    return aask_stream(question, k, model=route_model(question, models), filters=filters)
+
+def default_quorum(n_models: int) -> int:
+    if CONSENSUS_QUORUM > 0:
+        return min(CONSENSUS_QUORUM, n_models)
+    return n_models // 2 + 1
+
+def ok_candidate(model: str, answer: str, started: float, spent: Dict[str, float]) -> Dict:
+    # latency counts from admission; time waiting for a scheduler slot is reported as queued_ms
+    queued = spent.get("scheduler_wait", 0.0)
+    return {"model": model, "answer": answer, "latency_ms": round((time.perf_counter() - started - queued) * 1000, 1),
+            "queued_ms": round(queued * 1000, 1), "status": "ok"}
+
+def candidate_list(models: List[str], done_by_model: Dict[str, Dict], started: float, deadline: float) -> List[Dict]:
+    """Candidates in model order; ones without a result are `timeout` past the deadline, otherwise `skipped`."""
+    now = time.perf_counter()
+    latency = round((now - started) * 1000, 1)
+    status = "timeout" if now >= deadline else "skipped"
+    return [done_by_model.get(m) or {"model": m, "answer": "", "latency_ms": latency, "status": status} for m in models]
+
+def quorum_reached(quorum: int, abandoned: threading.Event) -> Callable[[str], None]:
+    """`chat(on_reply=...)` callback that abandons the remaining candidates once `quorum` of them have answered."""
+    lock = threading.Lock()
+    replies = [0]
+
+    def on_reply(answer: str) -> None:
+        with lock:
+            replies[0] += 1
+            if replies[0] >= quorum:
+                abandoned.set()
+    return on_reply
 
-    candidates: List[Dict] = []
-    for m in models:
-        ans = client.chat(model=m, messages=messages)
-        candidates.append({"model": m, "answer": ans})
+def generate_candidates(client: OllamaClient, models: List[str], messages: List[Dict], timeout: float = CONSENSUS_TIMEOUT,
+                        concurrency: int = CONSENSUS_CONCURRENCY, quorum: int = None) -> List[Dict]:
+    quorum = quorum or default_quorum(len(models))
+    started = time.perf_counter()
+    deadline = started + timeout
+    # set once the candidates are no longer wanted, so ones still queued for a model slot never run
+    abandoned = threading.Event()
+    on_reply = quorum_reached(quorum, abandoned)
 
+    def run(m: str) -> Dict:
+        t0 = time.perf_counter()
+        with collect_timings() as spent:
+            ans = client.chat(model=m, messages=messages, timeout=timeout, abort=abandoned, on_reply=on_reply)
+        return ok_candidate(m, ans, t0, spent)
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(models))))
+    # copy the context per task so per-request stage timings see the candidates
+    futures = {pool.submit(contextvars.copy_context().run, run, m): m for m in models}
+    done_by_model: Dict[str, Dict] = {}
+    pending = set(futures)
+    try:
+        while pending:
+            ok = sum(1 for c in done_by_model.values() if c["status"] == "ok")
+            if ok >= quorum:
+                break
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for f in done:
+                m = futures[f]
+                try:
+                    done_by_model[m] = f.result()
+                except CancelledError:
+                    pass  # withdrawn once quorum was reached; reported as skipped below
+                except Exception as e:
+                    latency = round((time.perf_counter() - started) * 1000, 1)
+                    done_by_model[m] = {"model": m, "answer": "", "latency_ms": latency, "status": "error", "error": str(e)}
+    finally:
+        abandoned.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return candidate_list(models, done_by_model, started, deadline)
+
+async def agenerate_candidates(client: OllamaClient, models: List[str], messages: List[Dict], timeout: float = CONSENSUS_TIMEOUT,
+                               concurrency: int = CONSENSUS_CONCURRENCY, quorum: int = None) -> List[Dict]:
+    quorum = quorum or default_quorum(len(models))
+    started = time.perf_counter()
+    deadline = started + timeout
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(m: str) -> Dict:
+        async with sem:
+            t0 = time.perf_counter()
+            with collect_timings() as spent:
+                ans = await client.achat(model=m, messages=messages, timeout=timeout)
+            return ok_candidate(m, ans, t0, spent)
+
+    tasks = {asyncio.create_task(run(m)): m for m in models}
+    done_by_model: Dict[str, Dict] = {}
+    pending = set(tasks)
+    try:
+        while pending:
+            ok = sum(1 for c in done_by_model.values() if c["status"] == "ok")
+            if ok >= quorum:
+                break
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                m = tasks[t]
+                try:
+                    done_by_model[m] = t.result()
+                except Exception as e:
+                    latency = round((time.perf_counter() - started) * 1000, 1)
+                    done_by_model[m] = {"model": m, "answer": "", "latency_ms": latency, "status": "error", "error": str(e)}
+    finally:
+        for t in pending:
+            t.cancel()
+
+    return candidate_list(models, done_by_model, started, deadline)
+
+def answered_candidates(candidates: List[Dict]) -> List[Dict]:
+    answered = [c for c in candidates if c["status"] == "ok"]
+    if not answered:
+        raise RuntimeError("No consensus candidate answered: " + ", ".join(f"{c['model']}={c['status']}" for c in candidates))
+    return answered
+
+def is_refusal(answer: str) -> bool:
+    return answer.strip().strip('"“”').strip() == REFUSAL
+
+def agreed_candidate(client: OllamaClient, candidates: List[Dict],
+                     threshold: float = CONSENSUS_AGREEMENT) -> Tuple[Optional[Dict], Optional[float]]:
+    """The answer to return without a judge when the answered candidates agree, and their agreement score.
+
+    All refusing counts as agreement; a mix of refusals and answers does not. Otherwise every pair of answer
+    embeddings must have cosine >= `threshold`, and the candidate closest to the rest is returned.
+    """
+    answered = [c for c in candidates if c["status"] == "ok"]
+    if threshold <= 0 or len(answered) < 2:
+        return None, None
+    refusals = [is_refusal(c["answer"]) for c in answered]
+    if all(refusals):
+        return {**answered[0], "answer": REFUSAL}, 1.0
+    if any(refusals):
+        return None, 0.0
+    try:
+        with timed("agreement"):
+            vecs = l2_normalize(client.embed_many([c["answer"] for c in answered], EMBED_MODEL))
+    except Exception as e:
+        print(f"WARN: could not embed consensus candidates ({e}); judging instead")
+        return None, None
+    sims = vecs @ vecs.T
+    score = round(float(sims.min()), 4)
+    if score < threshold:
+        return None, score
+    return answered[int(sims.sum(axis=1).argmax())], score
+
+def consensus_fields(candidates: List[Dict], judge_model: str, agreed: Optional[Dict], agreement: Optional[float]) -> Dict:
+    if agreed is None:
+        return {"candidates": candidates, "judge_model": judge_model, "judge_ran": True, "agreement": agreement}
+    return {"candidates": candidates, "model": agreed["model"], "judge_ran": False, "agreement": agreement}
+
+def judge_messages(messages: List[Dict], candidates: List[Dict]) -> List[Dict]:
     cand_lines = []
     for i, c in enumerate(candidates, start=1):
         cand_lines.append(f"[Candidate {i} — {c['model']}]\n{c['answer']}")
-    judge_system = '''You are a strict judge. Use ONLY the provided context to produce a final answer.
-If the context lacks the answer, respond EXACTLY: "I don't know from these PDFs."'''
+    judge_system = f'''You are a strict judge. Use ONLY the provided context to produce a final answer.
+If the context lacks the answer, respond EXACTLY: "{REFUSAL}"'''
     judge_user = (
         messages[1]["content"] + "\n\n"
         "Candidate answers to consider (choose or synthesize one final answer using only the context):\n\n"
         + "\n\n".join(cand_lines)
     )
-    final_answer = client.chat(model=judge_model, messages=[
+    return [
+        {"role": "system", "content": judge_system},
+        {"role": "user", "content": judge_user},
+    ]
+
+def compact_judge_messages(question: str, sources: List[Dict], candidates: List[Dict]) -> List[Dict]:
+    """Judge prompt with only the snippets the candidates cite ([n]) instead of the whole context again."""
+    cited = {int(n) for c in candidates for n in re.findall(r"\[(\d+)\]", c["answer"])}
+    snippets = [s for s in sources if s["n"] in cited] or sources
+    cand_lines = [f"[Candidate {i} — {c['model']}]\n{c['answer']}" for i, c in enumerate(candidates, start=1)]
+    judge_system = f'''You are a strict judge. Use ONLY the candidate answers and the cited passages to produce a final answer.
+Keep the [n] citations that the passages support. If none of them answers the question, respond EXACTLY: "{REFUSAL}"'''
+    judge_user = (
+        f"Question: {question}\n\nCited passages:\n\n"
+        + "\n\n".join(f"[{s['n']}] {s['doc']} p.{s['page']}:\n{s['snippet']}" for s in snippets)
+        + "\n\nCandidate answers (choose or synthesize one final answer):\n\n"
+        + "\n\n".join(cand_lines)
+    )
+    return [
         {"role": "system", "content": judge_system},
         {"role": "user", "content": judge_user},
-    ])
+    ]
+
+def judge_prompt(r: Retrieval, candidates: List[Dict]) -> List[Dict]:
+    if JUDGE_PROMPT == "compact":
+        return compact_judge_messages(r.question, r.sources, candidates)
+    return judge_messages(r.messages, candidates)
+
+@dataclass
+class Verdict:
+    """How a question's candidates resolve: the agreed answer, or the judge prompt still to run."""
+    fields: Dict
+    answer: Optional[str] = None
+    judge_messages: Optional[List[Dict]] = None
+
+    def done_event(self) -> dict:
+        return {"type": "done", "model": self.fields.get("judge_model") or self.fields.get("model"),
+                "judge_ran": self.fields["judge_ran"]}
+
+def settle(client: OllamaClient, r: Retrieval, candidates: List[Dict], judge_model: str) -> Verdict:
+    """Skip the judge when the answered candidates agree; raises RuntimeError when none of them answered."""
+    agreed, agreement = agreed_candidate(client, candidates)
+    fields = consensus_fields(candidates, judge_model, agreed, agreement)
+    if agreed is not None:
+        return Verdict(fields, answer=agreed["answer"])
+    return Verdict(fields, judge_messages=judge_prompt(r, answered_candidates(candidates)))
+
+def ask_consensus(question: str, k: int = TOP_K, models: List[str] = None, judge_model: str = None,
+                  timeout: float = CONSENSUS_TIMEOUT, concurrency: int = CONSENSUS_CONCURRENCY, quorum: int = None,
+                  retrieval: Optional[Retrieval] = None, filters: Optional[Dict] = None) -> dict:
+    models = models or LLM_MODELS[:3]
+    judge_model = judge_model or JUDGE_MODEL
+    if retrieval is not None:
+        question, k, filters = retrieval.question, retrieval.k, retrieval.filters
+    client = get_client()
+    scope = answer_scope("consensus", k, models, judge_model, filters)
+    hit, qv = lookup_answer(scope, question, client, retrieval.qv if retrieval else None)
+    if hit is not None:
+        return hit
+    r = retrieval or prepare(question, client, k, qv, filters)
+    if r.no_match:
+        return r.result(NO_MATCH, candidates=[], judge_ran=False)
+
+    with timed("candidates"):
+        candidates = generate_candidates(client, models, r.messages, timeout=timeout, concurrency=concurrency, quorum=quorum)
+    verdict = settle(client, r, candidates, judge_model)
+    if verdict.judge_messages is not None:
+        with timed("judge"):
+            verdict.answer = client.chat(model=judge_model, messages=verdict.judge_messages)
+
+    out = r.result(verdict.answer, **verdict.fields)
+    answer_cache.put(scope, question, r.qv, out)
+    return out
+
+async def aask_consensus(question: str, k: int = TOP_K, models: List[str] = None, judge_model: str = None,
+                         timeout: float = CONSENSUS_TIMEOUT, concurrency: int = CONSENSUS_CONCURRENCY, quorum: int = None,
+                         retrieval: Optional[Retrieval] = None, filters: Optional[Dict] = None) -> dict:
+    models = models or LLM_MODELS[:3]
+    judge_model = judge_model or JUDGE_MODEL
+    if retrieval is not None:
+        question, k, filters = retrieval.question, retrieval.k, retrieval.filters
+    client = get_client()
+    scope = await asyncio.to_thread(answer_scope, "consensus", k, models, judge_model, filters)
+    hit, qv = await alookup_answer(scope, question, client, retrieval.qv if retrieval else None)
+    if hit is not None:
+        return hit
+    r = retrieval or await aprepare(question, client, k, qv, filters)
+    if r.no_match:
+        return r.result(NO_MATCH, candidates=[], judge_ran=False)
+
+    with timed("candidates"):
+        candidates = await agenerate_candidates(client, models, r.messages, timeout=timeout, concurrency=concurrency, quorum=quorum)
+    verdict = await asyncio.to_thread(settle, client, r, candidates, judge_model)
+    if verdict.judge_messages is not None:
+        with timed("judge"):
+            verdict.answer = await client.achat(model=judge_model, messages=verdict.judge_messages)
+
+    out = r.result(verdict.answer, **verdict.fields)
+    answer_cache.put(scope, question, r.qv, out)
+    return out
+
+def ask_consensus_stream(question: str, k: int = TOP_K, models: List[str] = None, judge_model: str = None,
+                         timeout: float = CONSENSUS_TIMEOUT, concurrency: int = CONSENSUS_CONCURRENCY, quorum: int = None,
+                         retrieval: Optional[Retrieval] = None, filters: Optional[Dict] = None) -> Iterator[dict]:
+    models = models or LLM_MODELS[:3]
+    judge_model = judge_model or JUDGE_MODEL
+    if retrieval is not None:
+        question, k, filters = retrieval.question, retrieval.k, retrieval.filters
+    client = get_client()
+    scope = answer_scope("consensus", k, models, judge_model, filters)
+    hit, qv = lookup_answer(scope, question, client, retrieval.qv if retrieval else None)
+    if hit is not None:
+        yield from replay_answer(hit)
+        return
+    r = retrieval or prepare(question, client, k, qv, filters)
+    if r.no_match:
+        yield from no_match_events(r, model=None, judge_ran=False)
+        return
+    yield r.sources_event()
+
+    with timed("candidates"):
+        candidates = generate_candidates(client, models, r.messages, timeout=timeout, concurrency=concurrency, quorum=quorum)
+    yield {"type": "candidates", "candidates": candidates}
+    verdict = settle(client, r, candidates, judge_model)
+    if verdict.judge_messages is None:
+        pieces = [verdict.answer]
+        yield {"type": "token", "content": verdict.answer}
+    else:
+        pieces = []
+        for piece in client.chat_stream(model=judge_model, messages=verdict.judge_messages):
+            pieces.append(piece)
+            yield {"type": "token", "content": piece}
+    answer_cache.put(scope, question, r.qv, r.result("".join(pieces), **verdict.fields))
+    yield verdict.done_event()
+
+async def aask_consensus_stream(question: str, k: int = TOP_K, models: List[str] = None, judge_model: str = None,
+                                timeout: float = CONSENSUS_TIMEOUT, concurrency: int = CONSENSUS_CONCURRENCY, quorum: int = None,
+                                retrieval: Optional[Retrieval] = None, filters: Optional[Dict] = None) -> AsyncIterator[dict]:
+    models = models or LLM_MODELS[:3]
+    judge_model = judge_model or JUDGE_MODEL
+    if retrieval is not None:
+        question, k, filters = retrieval.question, retrieval.k, retrieval.filters
+    client = get_client()
+    scope = await asyncio.to_thread(answer_scope, "consensus", k, models, judge_model, filters)
+    hit, qv = await alookup_answer(scope, question, client, retrieval.qv if retrieval else None)
+    if hit is not None:
+        for ev in replay_answer(hit):
+            yield ev
+        return
+    r = retrieval or await aprepare(question, client, k, qv, filters)
+    if r.no_match:
+        for ev in no_match_events(r, model=None, judge_ran=False):
+            yield ev
+        return
+    yield r.sources_event()
 
-    return {"answer": final_answer, "sources": sources, "candidates": candidates, "judge_model": judge_model}
+    with timed("candidates"):
+        candidates = await agenerate_candidates(client, models, r.messages, timeout=timeout, concurrency=concurrency, quorum=quorum)
+    yield {"type": "candidates", "candidates": candidates}
+    verdict = await asyncio.to_thread(settle, client, r, candidates, judge_model)
+    if verdict.judge_messages is None:
+        pieces = [verdict.answer]
+        yield {"type": "token", "content": verdict.answer}
+    else:
+        pieces = []
+        async for piece in client.achat_stream(model=judge_model, messages=verdict.judge_messages):
+            pieces.append(piece)
+            yield {"type": "token", "content": piece}
+    answer_cache.put(scope, question, r.qv, r.result("".join(pieces), **verdict.fields))
+    yield verdict.done_event()
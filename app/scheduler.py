@@ -0,0 +1,182 @@
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import CancelledError
+from contextlib import contextmanager, asynccontextmanager
+from typing import Callable, Dict, Iterator, AsyncIterator, List, Optional
+
+from app.metrics import record, model_loads
+
+MODEL_SCHEDULER = os.getenv("MODEL_SCHEDULER", "on").lower() not in ("0", "off", "false", "no")
+MAX_LOADED_MODELS = int(os.getenv("MAX_LOADED_MODELS", 3))  # Ollama's own default limit
+MODEL_SLOTS = int(os.getenv("MODEL_SLOTS", 0))  # 0: no per-model cap
+AFFINITY_BATCH = int(os.getenv("AFFINITY_BATCH", 8))
+PREWARM_MODELS = [m.strip() for m in os.getenv("PREWARM_MODELS", "").split(",") if m.strip()]
+ABORT_POLL = 0.05
+
+
+class _Ticket:
+    __slots__ = ("model", "wake", "abort", "evict", "admitted", "queued_at")
+
+    def __init__(self, model: str, wake: Callable[[], None], abort: Optional[threading.Event] = None):
+        self.model = model
+        self.wake = wake
+        self.abort = abort
+        self.evict: List[str] = []
+        self.admitted = False
+        self.queued_at = time.perf_counter()
+
+
+class ModelScheduler:
+    """Admits chat requests so that at most `max_loaded` models are resident in Ollama.
+
+    Requests for an already-loaded model go first (up to `slots` at a time if set), so same-model work
+    is batched together. A loaded model yields to waiting models after serving `batch` requests
+    while they wait, and is then unloaded via `on_evict` (keep_alive=0) once idle.
+    """
+
+    def __init__(self, max_loaded: int = MAX_LOADED_MODELS, slots: int = MODEL_SLOTS, batch: int = AFFINITY_BATCH,
+                 on_evict: Optional[Callable[[str], None]] = None):
+        self.max_loaded = max(1, max_loaded)
+        self.slots = max(0, slots)
+        self.batch = max(1, batch)
+        self.on_evict = on_evict
+        self._lock = threading.Lock()
+        self._waiters: List[_Ticket] = []
+        self._active: Dict[str, int] = {}     # loaded model -> requests in flight
+        self._served: Dict[str, int] = {}     # loaded model -> requests admitted while a swap was pending
+        self._last_used: Dict[str, float] = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def _others_waiting(self, model: str) -> bool:
+        # only waiters that need a model swap count; work for other resident models is not blocked by us
+        return any(t.model != model and t.model not in self._active for t in self._waiters)
+
+    def _admit_loaded(self, model: str) -> bool:
+        if self.slots and self._active[model] >= self.slots:
+            return False
+        return self._served[model] < self.batch or not self._others_waiting(model)
+
+    def _victim(self) -> Optional[str]:
+        idle = [m for m, n in self._active.items() if n == 0
+                and (self._served[m] >= self.batch or not any(t.model == m for t in self._waiters))]
+        return min(idle, key=lambda m: self._last_used.get(m, 0.0)) if idle else None
+
+    def _dispatch(self) -> None:
+        # first pass: work for resident models; second pass: load (and maybe evict) for the rest, FIFO
+        for loaded_pass in (True, False):
+            for t in list(self._waiters):
+                if t.abort is not None and t.abort.is_set():
+                    # abandoned but not yet noticed by its waiter; never load a model for it
+                    self._waiters.remove(t)
+                    continue
+                model = t.model
+                if loaded_pass != (model in self._active):
+                    continue
+                if model in self._active:
+                    if not self._admit_loaded(model):
+                        continue
+                else:
+                    if len(self._active) >= self.max_loaded:
+                        victim = self._victim()
+                        if victim is None:
+                            continue
+                        del self._active[victim], self._served[victim]
+                        t.evict.append(victim)
+                        self.evictions += 1
+                    # a swap gives every resident model a fresh batch
+                    self._served = {m: 0 for m in self._active}
+                    self._active[model] = 0
+                    self._served[model] = 0
+                    self.loads += 1
+                    model_loads.inc(model=model)
+                self._waiters.remove(t)
+                if self._others_waiting(model):
+                    self._served[model] += 1
+                self._active[model] += 1
+                t.admitted = True
+                t.wake()
+
+    def _enqueue(self, t: _Ticket) -> None:
+        with self._lock:
+            self._waiters.append(t)
+            self._dispatch()
+
+    def _admitted(self, t: _Ticket) -> None:
+        record("scheduler_wait", time.perf_counter() - t.queued_at)
+        for victim in t.evict:
+            if self.on_evict is not None:
+                try:
+                    self.on_evict(victim)
+                except Exception as e:
+                    print(f"WARN: could not unload model {victim} ({e})")
+
+    def release(self, model: str) -> None:
+        with self._lock:
+            if model in self._active:
+                self._active[model] -= 1
+            self._last_used[model] = time.perf_counter()
+            self._dispatch()
+
+    def _abandon(self, t: _Ticket) -> bool:
+        """Drop a ticket that is no longer wanted; returns True if it had already been admitted."""
+        with self._lock:
+            if t in self._waiters:
+                self._waiters.remove(t)
+                self._dispatch()
+                return False
+        return t.admitted
+
+    @contextmanager
+    def slot(self, model: str, abort: Optional[threading.Event] = None) -> Iterator[None]:
+        """Hold a slot for `model`; setting `abort` withdraws a request that is still queued (CancelledError)."""
+        ready = threading.Event()
+        t = _Ticket(model, ready.set, abort)
+        self._enqueue(t)
+        while not ready.wait(ABORT_POLL if abort is not None else None):
+            if abort.is_set():
+                if not self._abandon(t):
+                    raise CancelledError(f"request for {model} abandoned while queued")
+                break  # admitted just as it was abandoned
+        try:
+            # unload any model evicted for this ticket even if the request is dropped now
+            self._admitted(t)
+            if abort is not None and abort.is_set():
+                raise CancelledError(f"request for {model} abandoned while queued")
+            yield
+        finally:
+            self.release(model)
+
+    @asynccontextmanager
+    async def aslot(self, model: str) -> AsyncIterator[None]:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        t = _Ticket(model, lambda: loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(None)))
+        self._enqueue(t)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if self._abandon(t):
+                self.release(model)
+            raise
+        try:
+            if t.evict:
+                await asyncio.to_thread(self._admitted, t)
+            else:
+                self._admitted(t)
+            yield
+        finally:
+            self.release(model)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "max_loaded": self.max_loaded,
+                "slots": self.slots,
+                "loaded": {m: {"active": n, "served": self._served[m]} for m, n in self._active.items()},
+                "waiting": [t.model for t in self._waiters],
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
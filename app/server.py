@@ -1,10 +1,26 @@
-from typing import List, Optional
-from fastapi import FastAPI
+import os
+import json
+import time
+import asyncio
+from typing import Dict, List, Optional, Union
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 
-from app.query import ask as ask_single
-from app.query_multi import ask_router, ask_consensus
+from app.query import aask as ask_single, aask_stream
+from app.query_multi import aask_router as ask_router, aask_consensus as ask_consensus, aask_router_stream, aask_consensus_stream
+from app.store import get_store
+from app.doc_map import normalize_filters
+from app.answer_cache import answer_cache
+from app.embed_cache import query_embeddings
+from app.batch import ask_batch, normalize_items, BATCH_CONCURRENCY
+from app.metrics import collect_timings, render_metrics, ask_seconds
+from app.utils.ollama_client import get_client
+from app.scheduler import PREWARM_MODELS
+
+ASK_TIMEOUT = float(os.getenv("ASK_TIMEOUT", 900))
+DISCONNECT_POLL = 0.5
 
 app = FastAPI(title="PDF QA — OCR + Incremental + Multi-Model (v4)")
 
@@ -16,26 +32,165 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def load_store():
+    # load off the event loop so the server accepts connections right away; early queries wait in get_store()
+    async def load():
+        try:
+            await asyncio.to_thread(get_store)
+        except Exception as e:
+            print(f"WARN: store not loaded at startup ({e}). It will be loaded on first query.")
+
+    app.state.store_load = asyncio.create_task(load())
+
+@app.on_event("startup")
+async def prewarm_models():
+    client = get_client()
+    if not PREWARM_MODELS:
+        return
+    models = PREWARM_MODELS[:client.scheduler.max_loaded] if client.scheduler else PREWARM_MODELS
+
+    async def warm():
+        try:
+            await asyncio.to_thread(client.prewarm, models)
+        except Exception as e:
+            print(f"WARN: could not prewarm {', '.join(models)} ({e})")
+
+    app.state.prewarm = asyncio.create_task(warm())
+
+@app.on_event("shutdown")
+async def close_client():
+    await get_client().aclose()
+
+async def run_cancellable(request: Request, coro, timeout: float = ASK_TIMEOUT):
+    task = asyncio.ensure_future(coro)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise HTTPException(status_code=504, detail=f"Answer not ready within {timeout:.0f}s")
+            done, _ = await asyncio.wait({task}, timeout=min(DISCONNECT_POLL, remaining))
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        if not task.done():
+            task.cancel()
+
 class AskRequest(BaseModel):
     question: str
     top_k: Optional[int] = None
     mode: Optional[str] = None          
     models: Optional[List[str]] = None  
     judge_model: Optional[str] = None
+    docs: Optional[List[str]] = None    # document name globs, e.g. "manual*.pdf"
+    paths: Optional[List[str]] = None   # source path globs
+    pages: Optional[List[int]] = None   # [first, last], inclusive
+    timings: bool = False
+
+def request_filters(req) -> Optional[Dict]:
+    try:
+        return normalize_filters({"docs": req.docs, "paths": req.paths, "pages": req.pages})
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
 class AskResponse(BaseModel):
     answer: str
     sources: list[dict]
+    candidates: Optional[list[dict]] = None
+    judge_model: Optional[str] = None
+    judge_ran: Optional[bool] = None
+    agreement: Optional[float] = None
+    cached: Optional[str] = None
+    context: Optional[dict] = None
+    timings: Optional[dict] = None
 
 @app.post("/ask", response_model=AskResponse)
-async def ask_api(req: AskRequest):
+async def ask_api(req: AskRequest, request: Request):
     k = req.top_k or 5
     mode = (req.mode or "off").lower()
+    filters = request_filters(req)
+    started = time.perf_counter()
+    with collect_timings() as timings:
+        if mode == "router":
+            res = await run_cancellable(request, ask_router(req.question, k=k, models=req.models, filters=filters))
+        elif mode == "consensus":
+            res = await run_cancellable(request, ask_consensus(req.question, k=k, models=req.models, judge_model=req.judge_model,
+                                                               filters=filters))
+        else:
+            mode = "off"
+            res = await run_cancellable(request, ask_single(req.question, k=k, filters=filters))
+    total = time.perf_counter() - started
+    ask_seconds.observe(total, mode=mode, cached=res.get("cached") or "no")
+    if req.timings:
+        timings = {stage: round(sec * 1000, 2) for stage, sec in timings.items()}
+        timings["total"] = round(total * 1000, 2)
+    return AskResponse(answer=res["answer"], sources=res["sources"], candidates=res.get("candidates"),
+                       judge_model=res.get("judge_model"), judge_ran=res.get("judge_ran"), agreement=res.get("agreement"),
+                       cached=res.get("cached"), context=res.get("context"),
+                       timings=timings if req.timings else None)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+class BatchRequest(BaseModel):
+    questions: List[Union[str, Dict]]
+    top_k: Optional[int] = None
+    mode: Optional[str] = None
+    models: Optional[List[str]] = None
+    judge_model: Optional[str] = None
+    concurrency: Optional[int] = None
+    docs: Optional[List[str]] = None
+    paths: Optional[List[str]] = None
+    pages: Optional[List[int]] = None
+
+@app.post("/ask/batch")
+def ask_batch_api(req: BatchRequest):
+    try:
+        items = normalize_items(req.questions)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    results = ask_batch(items, k=req.top_k or 5, mode=req.mode or "off", models=req.models,
+                        judge_model=req.judge_model, concurrency=req.concurrency or BATCH_CONCURRENCY,
+                        filters=request_filters(req))
+    lines = (json.dumps(res, ensure_ascii=False) + "\n" for res in results)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+@app.get("/documents")
+def documents():
+    store = get_store()
+    return {"generation": store.generation, "documents": store.docmap.summary(store.dead_rows)}
+
+@app.get("/scheduler")
+def scheduler_stats():
+    scheduler = get_client().scheduler
+    return scheduler.stats() if scheduler else {"enabled": False}
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {**answer_cache.stats(), "query_embeddings": query_embeddings.stats()}
+
+@app.post("/ask/stream")
+async def ask_stream_api(req: AskRequest):
+    k = req.top_k or 5
+    mode = (req.mode or "off").lower()
+    filters = request_filters(req)
     if mode == "router":
-        res = ask_router(req.question, k=k, models=req.models)
-        return AskResponse(answer=res["answer"], sources=res["sources"])
-    if mode == "consensus":
-        res = ask_consensus(req.question, k=k, models=req.models, judge_model=req.judge_model)
-        return AskResponse(answer=res["answer"], sources=res["sources"])
-    res = ask_single(req.question, k=k)
-    return AskResponse(answer=res["answer"], sources=res["sources"])
+        events = aask_router_stream(req.question, k=k, models=req.models, filters=filters)
+    elif mode == "consensus":
+        events = aask_consensus_stream(req.question, k=k, models=req.models, judge_model=req.judge_model, filters=filters)
+    else:
+        events = aask_stream(req.question, k=k, filters=filters)
+
+    async def sse():
+        try:
+            async for ev in events:
+                yield f"event: {ev['type']}\ndata: {json.dumps(ev, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'type': 'error', 'detail': str(e)})}\n\n"
+
+    return StreamingResponse(sse(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,281 @@
+import os
+import json
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.bm25 import BM25Index
+from app.chunk_store import ChunkStore
+from app.doc_map import DocMap
+from app.metrics import timed
+from app.vector_index import configure_search, load_index, load_vectors
+
+STORE_DIR = Path(os.getenv("STORE_DIR", "store"))
+KEEP_GENERATIONS = int(os.getenv("KEEP_GENERATIONS", 2))
+GENERATIONS_DIR = "generations"
+CURRENT_FILE = "CURRENT"
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.jsonl"
+MANIFEST_FILE = "manifest.json"
+BM25_FILE = "bm25.npz"
+FILES_FILE = "files.json"
+TOMBSTONES_FILE = "tombstones.npy"
+VECTORS_FILE = "vectors.f32"
+DOCS_FILE = "docs.npz"
+WATCHED_FILES = (MANIFEST_FILE, INDEX_FILE, CHUNKS_FILE, BM25_FILE, TOMBSTONES_FILE, VECTORS_FILE, DOCS_FILE)
+STORE_FILES = WATCHED_FILES + (FILES_FILE, CHUNKS_FILE + ".offsets")
+
+
+def _legacy_stamp(store_dir: Path) -> tuple:
+    parts = []
+    for name in WATCHED_FILES:
+        try:
+            st = (store_dir / name).stat()
+            parts.append((name, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            parts.append((name, None, None))
+    return tuple(parts)
+
+
+def current_generation(store_root: Path = STORE_DIR) -> Tuple[tuple, Path]:
+    """(stamp, directory) of the published store.
+
+    Each build is written to its own `generations/<n>` directory and published by atomically replacing the
+    CURRENT pointer, so a generation never changes once readers can see it. A store without CURRENT is the
+    older flat layout, where files are watched by mtime and size instead.
+    """
+    try:
+        name = (store_root / CURRENT_FILE).read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return _legacy_stamp(store_root), store_root
+    return (CURRENT_FILE, name), store_root / GENERATIONS_DIR / name
+
+
+def current_dir(store_root: Path = STORE_DIR) -> Path:
+    return current_generation(store_root)[1]
+
+
+def store_stamp(store_root: Path = STORE_DIR) -> tuple:
+    return current_generation(store_root)[0]
+
+
+def read_manifest(store_dir: Optional[Path] = None) -> Dict:
+    path = (store_dir or current_dir()) / MANIFEST_FILE
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def write_manifest(manifest: Dict, store_dir: Path) -> Dict:
+    manifest = dict(manifest)
+    if store_dir.parent.name == GENERATIONS_DIR:
+        manifest["generation"] = int(store_dir.name)
+    else:
+        manifest["generation"] = int(read_manifest(store_dir).get("generation", 0)) + 1
+    tmp = store_dir / (MANIFEST_FILE + ".tmp")
+    tmp.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    os.replace(tmp, store_dir / MANIFEST_FILE)
+    return manifest
+
+
+def new_generation(base: Optional[Path] = None, copy: Sequence[str] = (), store_root: Path = STORE_DIR) -> Path:
+    """Create an unpublished generation directory.
+
+    With `base`, its files are hard-linked in, so only what the writer replaces costs disk; files named in
+    `copy` are real copies because the writer appends to them. Writers must replace (never rewrite) linked files.
+    """
+    current = current_dir(store_root)
+    number = int(read_manifest(current).get("generation", 0)) + 1
+    if current.parent.name == GENERATIONS_DIR:
+        number = max(number, int(current.name) + 1)
+    gens = store_root / GENERATIONS_DIR
+    gens.mkdir(parents=True, exist_ok=True)
+    path = gens / f"{number:06d}"
+    # a leftover directory with this number was never published
+    shutil.rmtree(path, ignore_errors=True)
+    path.mkdir()
+    if base is not None:
+        for name in STORE_FILES:
+            src = base / name
+            if not src.exists():
+                continue
+            if name in copy:
+                shutil.copy2(src, path / name)
+                continue
+            try:
+                os.link(src, path / name)
+            except OSError:
+                shutil.copy2(src, path / name)
+    return path
+
+
+def publish(gen_dir: Path, store_root: Path = STORE_DIR) -> None:
+    """Atomically point CURRENT at `gen_dir`; running readers switch on their next query."""
+    tmp = store_root / (CURRENT_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(gen_dir.name + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, store_root / CURRENT_FILE)
+    invalidate_store()
+    gc_generations(store_root)
+
+
+def gc_generations(store_root: Path = STORE_DIR, keep: int = KEEP_GENERATIONS) -> List[str]:
+    """Delete generations older than the newest `keep` up to CURRENT, plus files of the flat layout.
+
+    Readers that still hold an old generation keep working: its files stay open or mapped until they let go.
+    """
+    _, current = current_generation(store_root)
+    if current.parent.name != GENERATIONS_DIR:
+        return []
+    for name in STORE_FILES:
+        (store_root / name).unlink(missing_ok=True)
+    gens = sorted((p for p in (store_root / GENERATIONS_DIR).iterdir() if p.is_dir() and p.name.isdigit()),
+                  key=lambda p: int(p.name))
+    # anything newer than CURRENT is another writer's unpublished build
+    older = [p for p in gens if int(p.name) < int(current.name)]
+    removed = older[:max(0, len(older) - max(0, keep - 1))]
+    for p in removed:
+        shutil.rmtree(p, ignore_errors=True)
+    return [p.name for p in removed]
+
+
+def load_tombstones(store_dir: Optional[Path] = None) -> np.ndarray:
+    path = (store_dir or current_dir()) / TOMBSTONES_FILE
+    if not path.exists():
+        return np.zeros(0, dtype="int64")
+    return np.load(path)
+
+
+def save_tombstones(dead: np.ndarray, store_dir: Path) -> None:
+    path = store_dir / TOMBSTONES_FILE
+    if len(dead) == 0:
+        path.unlink(missing_ok=True)
+        return
+    with open(store_dir / (TOMBSTONES_FILE + ".tmp"), "wb") as f:
+        np.save(f, np.unique(dead).astype("int64"))
+    os.replace(store_dir / (TOMBSTONES_FILE + ".tmp"), path)
+
+
+def load_fingerprints(store_dir: Optional[Path] = None) -> Dict[str, Dict]:
+    path = (store_dir or current_dir()) / FILES_FILE
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def save_fingerprints(fingerprints: Dict[str, Dict], store_dir: Path) -> None:
+    tmp = store_dir / (FILES_FILE + ".tmp")
+    tmp.write_text(json.dumps(fingerprints, indent=2), encoding="utf-8")
+    os.replace(tmp, store_dir / FILES_FILE)
+
+
+class Store:
+    def __init__(self, index, chunks: ChunkStore, manifest: Dict, stamp: tuple, bm25: Optional[BM25Index] = None,
+                 dead: Optional[np.ndarray] = None, vectors: Optional[np.ndarray] = None, docmap: Optional[DocMap] = None):
+        self.index = index
+        self.vectors = vectors
+        self.chunks = chunks
+        self.manifest = manifest
+        self.stamp = stamp
+        self.bm25 = bm25
+        self.dead_rows = np.unique(dead if dead is not None else np.zeros(0, dtype="int64")).astype("int64")
+        self.dead = frozenset(self.dead_rows.tolist())
+        self._docmap = docmap
+        self._docmap_lock = threading.Lock()
+
+    @property
+    def generation(self) -> int:
+        return int(self.manifest.get("generation", 0))
+
+    @property
+    def live_count(self) -> int:
+        return self.index.ntotal - len(self.dead)
+
+    @property
+    def docmap(self) -> DocMap:
+        if self._docmap is None:
+            with self._docmap_lock:
+                if self._docmap is None:
+                    # generations built before docs.npz existed
+                    self._docmap = DocMap.from_chunks(self.chunks.path)
+        return self._docmap
+
+    def filter_rows(self, filters: Dict) -> np.ndarray:
+        return self.docmap.rows(filters, self.dead_rows)
+
+    @classmethod
+    def load(cls, store_dir: Optional[Path] = None, stamp: Optional[tuple] = None) -> "Store":
+        with timed("store_load"):
+            if store_dir is None:
+                stamp, store_dir = current_generation()
+            elif stamp is None:
+                stamp = _legacy_stamp(store_dir)
+            manifest = read_manifest(store_dir)
+            cfg = manifest.get("index", {})
+            index = load_index(store_dir / INDEX_FILE, cfg)
+            chunks = ChunkStore(store_dir / CHUNKS_FILE)
+            configure_search(index, cfg)
+            vectors = load_vectors(store_dir / VECTORS_FILE, index.d) if cfg.get("rescore") else None
+            if vectors is not None and len(vectors) != index.ntotal:
+                print(f"WARN: {VECTORS_FILE} has {len(vectors)} rows for {index.ntotal} vectors. Skipping exact re-scoring.")
+                vectors = None
+            bm25_path = store_dir / BM25_FILE
+            bm25 = BM25Index.load(bm25_path) if bm25_path.exists() else None
+            docmap = DocMap.load(store_dir / DOCS_FILE) if (store_dir / DOCS_FILE).exists() else None
+            if docmap is not None and len(docmap) != index.ntotal:
+                docmap = None
+            return cls(index, chunks, manifest, stamp, bm25, load_tombstones(store_dir), vectors, docmap)
+
+
+_lock = threading.Lock()
+_swapping = threading.Lock()
+_store: Optional[Store] = None
+
+
+def _load_current() -> Store:
+    global _store
+    stamp, path = current_generation()
+    if _store is None or _store.stamp != stamp:
+        _store = Store.load(path, stamp)
+    return _store
+
+
+def _swap() -> None:
+    try:
+        with _lock:
+            _load_current()
+    except Exception as e:
+        print(f"WARN: could not load the new store generation ({e}). Still serving the previous one.")
+    finally:
+        _swapping.release()
+
+
+def get_store() -> Store:
+    current = _store
+    stamp, _ = current_generation()
+    if current is not None and current.stamp == stamp:
+        return current
+    if current is None:
+        with _lock:
+            return _load_current()
+    # a newly published generation loads in the background; queries keep using the previous one meanwhile
+    if _swapping.acquire(blocking=False):
+        threading.Thread(target=_swap, name="store-swap", daemon=True).start()
+    return current
+
+
+def invalidate_store() -> None:
+    global _store
+    with _lock:
+        _store = None
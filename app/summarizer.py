@@ -1,11 +1,8 @@
 import os
 import requests
-from dotenv import load_dotenv
 from bs4 import BeautifulSoup
 import ollama
 
-load_dotenv()
-
 headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/117.0.0.0 Safari/537.36"
 }
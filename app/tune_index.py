@@ -0,0 +1,90 @@
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from app.store import get_store
+from app.vector_index import INDEX_TYPES, STORAGE_TYPES, index_config, bytes_per_vector, factory_string, build_index, set_search_param, reconstruct_all
+
+NPROBE_SWEEP = [1, 2, 4, 8, 16, 32, 64, 128]
+EF_SEARCH_SWEEP = [16, 32, 64, 128, 256, 512]
+
+
+def stored_vectors() -> np.ndarray:
+    store = get_store()
+    return store.vectors if store.vectors is not None else reconstruct_all(store.index)
+
+
+def make_queries(vecs: np.ndarray, n: int, noise: float, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    picks = vecs[rng.choice(len(vecs), min(n, len(vecs)), replace=False)]
+    q = picks + noise * rng.standard_normal(picks.shape).astype("float32")
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    return q.astype("float32")
+
+
+def measure(index, queries: np.ndarray, truth: np.ndarray, k: int) -> dict:
+    lat = []
+    found = np.empty((len(queries), k), dtype="int64")
+    for i, q in enumerate(queries):
+        t0 = time.perf_counter()
+        _, ids = index.search(q[None, :], k)
+        lat.append((time.perf_counter() - t0) * 1000)
+        found[i] = ids[0]
+    hits = sum(len(set(found[i]) & set(truth[i])) for i in range(len(queries)))
+    return {
+        "recall": hits / float(truth.size),
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p99_ms": float(np.percentile(lat, 99)),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Measure recall@k and search latency of ANN index types against the exact flat index.")
+    ap.add_argument("--types", default=",".join(t for t in INDEX_TYPES if t != "flat"))
+    ap.add_argument("--storage", default="float32", help=f"comma-separated subset of {','.join(STORAGE_TYPES)} to build each type with")
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--noise", type=float, default=0.05, help="Gaussian noise added to sampled stored vectors to form queries")
+    args = ap.parse_args()
+
+    vecs = np.ascontiguousarray(stored_vectors(), dtype="float32")
+    queries = make_queries(vecs, args.queries, args.noise)
+    exact = faiss.IndexFlatIP(vecs.shape[1])
+    exact.add(vecs)
+    _, truth = exact.search(queries, args.k)
+    base = measure(exact, queries, truth, args.k)
+    print(f"{len(vecs)} vectors, dim={vecs.shape[1]}, {len(queries)} queries, recall@{args.k}")
+    print(f"{'index':<14} {'param':<14} {'recall':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    print(f"{'flat':<14} {'-':<14} {base['recall']:>8.3f} {base['p50_ms']:>9.3f} {base['p99_ms']:>9.3f}")
+
+    storages = [t.strip() for t in args.storage.split(",") if t.strip()]
+    seen = set()
+    for kind in [t.strip() for t in args.types.split(",") if t.strip()]:
+        for storage in storages:
+            cfg = index_config(len(vecs), vecs.shape[1], kind, storage)
+            if factory_string(cfg) in seen:
+                continue
+            seen.add(factory_string(cfg))
+            t0 = time.perf_counter()
+            index = build_index(vecs, cfg)
+            build_s = time.perf_counter() - t0
+            if cfg["type"] == "hnsw":
+                param, sweep = "ef_search", EF_SEARCH_SWEEP
+            elif cfg["type"] == "flat":
+                param, sweep = "-", [None]
+            else:
+                param, sweep = "nprobe", [p for p in NPROBE_SWEEP if p <= cfg["nlist"]]
+            label = cfg["type"] if cfg["storage"] == "float32" or cfg["type"] == "ivf_pq" else f"{cfg['type']}/{cfg['storage']}"
+            print(f"# {label} built in {build_s:.2f}s ({faiss.downcast_index(index).__class__.__name__}, "
+                  f"{bytes_per_vector(cfg, vecs.shape[1]):g} bytes/vector)")
+            for value in sweep:
+                if value is not None:
+                    set_search_param(index, cfg["type"], value)
+                r = measure(index, queries, truth, args.k)
+                name = param if value is None else f"{param}={value}"
+                print(f"{label:<14} {name:<14} {r['recall']:>8.3f} {r['p50_ms']:>9.3f} {r['p99_ms']:>9.3f}")
+
+if __name__ == "__main__":
+    main()
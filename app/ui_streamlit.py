@@ -11,11 +11,11 @@ if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
 
 # Import the query and other modules after modifying sys.path
-from app.query import ask as ask_single
-from app.query_multi import ask_router, ask_consensus, LLM_MODELS, JUDGE_MODEL
-from app.ingest import main as ingest_main, DATA_DIR
-from app.incremental_ingest import main as incr_main
-from app.summarizer import display_summary  # Import the summarizer logic
+from app.query import ask_stream
+from app.query_multi import ask_router_stream, ask_consensus_stream, LLM_MODELS, JUDGE_MODEL
+from app.store import get_store
+from app.doc_map import normalize_filters
+# the summarizer (bs4, ollama) is imported when first used so the UI starts with only the query path loaded
 
 # page_icon = str(ICON_PATH) if ICON_PATH.exists() else None
 
@@ -51,21 +51,57 @@ def main_page():
         else:
             judge_sel = None
 
+        with st.expander("Filter documents"):
+            try:
+                store = get_store()
+                documents = store.docmap.summary(store.dead_rows)
+            except Exception:
+                documents = []
+            docs_sel = st.multiselect("Only these documents", options=[d["doc"] for d in documents])
+            max_page = max([d["pages"] for d in documents] or [1])
+            use_pages = st.checkbox("Only a page range")
+            pages_sel = st.slider("Pages", min_value=1, max_value=max(max_page, 2), value=(1, max(max_page, 2)),
+                                  disabled=not use_pages)
+        filters = normalize_filters({"docs": docs_sel, "pages": list(pages_sel) if use_pages else None})
+
         if st.button("Ask") and q.strip():
+            st.subheader("Answer")
+            answer_box = st.empty()
+            answer = ""
+            res = {}
             with st.spinner("Thinking..."):
                 try:
                     if mode == "router":
-                        res = ask_router(q, k=top_k, models=models_sel or None)
+                        events = ask_router_stream(q, k=top_k, models=models_sel or None, filters=filters)
                     elif mode == "consensus":
-                        res = ask_consensus(q, k=top_k, models=models_sel or None, judge_model=judge_sel)
+                        events = ask_consensus_stream(q, k=top_k, models=models_sel or None, judge_model=judge_sel,
+                                                      filters=filters)
                     else:
-                        res = ask_single(q, k=top_k)
+                        events = ask_stream(q, k=top_k, filters=filters)
+                    for ev in events:
+                        if ev["type"] == "token":
+                            answer += ev["content"]
+                            answer_box.markdown(answer + "▌")
+                        else:
+                            res.update(ev)
                 except Exception as e:
                     st.error(f"Backend error: {e}")
                     raise
+            answer_box.markdown(answer or "(no answer)")
+            ctx = res.get("context")
+            if ctx:
+                st.caption(f"Context: {ctx['context_tokens']} of {ctx['budget_tokens']} tokens, "
+                           f"{ctx['blocks']} blocks from {ctx['chunks']} chunks")
 
-            st.subheader("Answer")
-            st.write(res.get("answer", "(no answer)"))
+            if res.get("judge_ran") is False:
+                st.caption(f"Candidates agreed; answer taken from {res.get('model')} without the judge")
+            if res.get("candidates"):
+                with st.expander("Consensus candidates"):
+                    for c in res["candidates"]:
+                        queued = f" (+{c['queued_ms']} ms queued)" if c.get("queued_ms") else ""
+                        st.markdown(f"**{c['model']}** — {c['status']}, {c['latency_ms']} ms{queued}")
+                        if c.get("answer"):
+                            st.write(c["answer"])
 
     with tab2:
         st.header("Summarize Text")
@@ -73,6 +109,7 @@ def main_page():
         
         if st.button("Summarize") and summarize_input.strip():
             with st.spinner("Summarizing..."):
+                from app.summarizer import display_summary  # loaded on first use
                 summarized_content = display_summary(summarize_input)
                 st.subheader("Summary")
                 st.write(summarized_content)
@@ -1,3 +1,4 @@
+import os
 import hashlib
 from typing import Dict
 
@@ -6,3 +7,14 @@ def make_uid(meta: Dict, text: str) -> str:
     page = str(meta.get("page", ""))
     payload = f"{doc}|{page}|{len(text)}|{text}".encode("utf-8", errors="ignore")
     return hashlib.sha1(payload).hexdigest()
+
+def file_sha1(path, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def file_fingerprint(path) -> Dict:
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": file_sha1(path)}
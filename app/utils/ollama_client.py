@@ -1,32 +1,146 @@
 import os
+import json
+import asyncio
+import threading
+from contextlib import nullcontext, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, List, Dict, Any, Optional, Iterator, AsyncIterator
+
+import numpy as np
 import requests
-from typing import List, Dict, Any
+from requests.adapters import HTTPAdapter
+
+from app.metrics import timed, record_ollama
+from app.scheduler import ModelScheduler, MODEL_SCHEDULER
+
+if TYPE_CHECKING:
+    import httpx
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", 4))
+HTTP_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", 16))
+KEEP_ALIVE = os.getenv("KEEP_ALIVE", "30m")
 
 class OllamaClient:
-    def __init__(self, base_url: str | None = None):
+    def __init__(self, base_url: str | None = None, scheduler: ModelScheduler | None = None):
         self.base_url = base_url or os.getenv("OLLAMA_HOST", "http://localhost:11434")
         if self.base_url.endswith("/"):
             self.base_url = self.base_url[:-1]
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._batch_supported: Optional[bool] = None
+        self._batch_lock = threading.Lock()
+        self._aclient: Optional["httpx.AsyncClient"] = None
+        self._aclient_loop = None
+        self.scheduler = scheduler
+
+    def _slot(self, model: str, abort: Optional[threading.Event] = None):
+        return self.scheduler.slot(model, abort) if self.scheduler is not None else nullcontext()
+
+    @asynccontextmanager
+    async def _aslot(self, model: str):
+        if self.scheduler is None:
+            yield
+            return
+        async with self.scheduler.aslot(model):
+            yield
+
+    def _async_client(self) -> "httpx.AsyncClient":
+        import httpx  # only the async (API server) paths need httpx, so sync callers never import it
+        loop = asyncio.get_running_loop()
+        if self._aclient is None or self._aclient_loop is not loop:
+            limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+            self._aclient = httpx.AsyncClient(base_url=self.base_url, limits=limits)
+            self._aclient_loop = loop
+        return self._aclient
+
+    @staticmethod
+    def _atimeout(timeout: float) -> "httpx.Timeout":
+        import httpx
+        return httpx.Timeout(timeout, connect=10)
+
+    async def aclose(self) -> None:
+        if self._aclient is not None:
+            await self._aclient.aclose()
+            self._aclient = None
 
     def embed(self, text: str, model: str) -> list[float]:
         url = f"{self.base_url}/api/embeddings"
         payload = {"model": model, "prompt": text}
-        r = requests.post(url, json=payload, timeout=300)
-        r.raise_for_status()
-        data = r.json()
+        with timed("ollama_embed"):
+            r = self.session.post(url, json=payload, timeout=300)
+            r.raise_for_status()
+            data = r.json()
         return data["embedding"]
 
-    def chat(self, model: str, messages: List[Dict[str, str]], temperature: float = 0.2) -> str:
-        url = f"{self.base_url}/api/chat"
-        payload: Dict[str, Any] = {
+    def embed_batch(self, texts: List[str], model: str) -> list[list[float]]:
+        if self._batch_supported is not False:
+            with timed("ollama_embed"):
+                r = self.session.post(f"{self.base_url}/api/embed", json={"model": model, "input": texts}, timeout=300)
+                if r.status_code != 404 or self._batch_supported is not None:
+                    r.raise_for_status()
+                    self._batch_supported = True
+                    return r.json()["embeddings"]
+            with self._batch_lock:
+                self._batch_supported = False
+        return [self.embed(t, model) for t in texts]
+
+    def embed_many(
+        self,
+        texts: List[str],
+        model: str,
+        batch_size: int = EMBED_BATCH_SIZE,
+        concurrency: int = EMBED_CONCURRENCY,
+        progress=None,
+    ) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, 0), dtype="float32")
+        batch_size = max(1, batch_size)
+        starts = list(range(0, len(texts), batch_size))
+        first = self.embed_batch(texts[:batch_size], model)
+        out = np.empty((len(texts), len(first[0])), dtype="float32")
+        out[:len(first)] = first
+        if progress:
+            progress(len(first))
+
+        def run(start: int) -> None:
+            vecs = self.embed_batch(texts[start:start + batch_size], model)
+            out[start:start + len(vecs)] = vecs
+            if progress:
+                progress(len(vecs))
+
+        rest = starts[1:]
+        if concurrency <= 1 or len(rest) <= 1:
+            for start in rest:
+                run(start)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                for f in [pool.submit(run, s) for s in rest]:
+                    f.result()
+        return out
+
+    async def aembed(self, text: str, model: str, timeout: float = 300) -> list[float]:
+        with timed("ollama_embed"):
+            r = await self._async_client().post("/api/embeddings", json={"model": model, "prompt": text},
+                                                timeout=self._atimeout(timeout))
+            r.raise_for_status()
+            data = r.json()
+        return data["embedding"]
+
+    @staticmethod
+    def _chat_payload(model: str, messages: List[Dict[str, str]], temperature: float, stream: bool) -> Dict[str, Any]:
+        return {
             "model": model,
             "messages": messages,
-            "stream": False,
+            "stream": stream,
             "options": {"temperature": temperature, "num_ctx": int(os.getenv("NUM_CTX", "8192"))},
+            "keep_alive": KEEP_ALIVE,
         }
-        r = requests.post(url, json=payload, timeout=600)
-        r.raise_for_status()
-        data = r.json()
+
+    @staticmethod
+    def _chat_content(data: Any) -> str:
         if isinstance(data, dict):
             msg = data.get("message") or {}
             content = msg.get("content")
@@ -34,9 +148,99 @@ class OllamaClient:
                 return content
         return data.get("response", "")
 
+    def chat(self, model: str, messages: List[Dict[str, str]], temperature: float = 0.2, timeout: float = 600,
+             abort: Optional[threading.Event] = None, on_reply: Optional[Callable[[str], None]] = None) -> str:
+        """`abort` withdraws the request while it still waits for a scheduler slot.
+
+        `on_reply` gets the answer before the slot is released, so it can set `abort` on sibling requests
+        before the scheduler admits one of them into the freed slot.
+        """
+        url = f"{self.base_url}/api/chat"
+        payload = self._chat_payload(model, messages, temperature, stream=False)
+        with self._slot(model, abort):
+            with timed("llm_chat"):
+                r = self.session.post(url, json=payload, timeout=timeout)
+                r.raise_for_status()
+                data = r.json()
+            answer = self._chat_content(data)
+            if on_reply is not None:
+                on_reply(answer)
+        record_ollama(model, data)
+        return answer
+
+    async def achat(self, model: str, messages: List[Dict[str, str]], temperature: float = 0.2, timeout: float = 600) -> str:
+        payload = self._chat_payload(model, messages, temperature, stream=False)
+        async with self._aslot(model):
+            with timed("llm_chat"):
+                r = await self._async_client().post("/api/chat", json=payload, timeout=self._atimeout(timeout))
+            r.raise_for_status()
+            data = r.json()
+        record_ollama(model, data)
+        return self._chat_content(data)
+
+    def chat_stream(self, model: str, messages: List[Dict[str, str]], temperature: float = 0.2, timeout: float = 600) -> Iterator[str]:
+        url = f"{self.base_url}/api/chat"
+        payload = self._chat_payload(model, messages, temperature, stream=True)
+        with self._slot(model), self.session.post(url, json=payload, timeout=timeout, stream=True) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                piece = (data.get("message") or {}).get("content") or data.get("response") or ""
+                if piece:
+                    yield piece
+                if data.get("done"):
+                    record_ollama(model, data)
+                    break
+
+    async def achat_stream(self, model: str, messages: List[Dict[str, str]], temperature: float = 0.2, timeout: float = 600) -> AsyncIterator[str]:
+        payload = self._chat_payload(model, messages, temperature, stream=True)
+        async with self._aslot(model), self._async_client().stream("POST", "/api/chat", json=payload, timeout=self._atimeout(timeout)) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                piece = (data.get("message") or {}).get("content") or data.get("response") or ""
+                if piece:
+                    yield piece
+                if data.get("done"):
+                    record_ollama(model, data)
+                    break
+
+    def load_model(self, model: str, keep_alive: str | int = KEEP_ALIVE) -> None:
+        # a generate request without a prompt just loads the model (keep_alive=0 unloads it)
+        r = self.session.post(f"{self.base_url}/api/generate", json={"model": model, "keep_alive": keep_alive}, timeout=600)
+        r.raise_for_status()
+
+    def unload_model(self, model: str) -> None:
+        self.load_model(model, keep_alive=0)
+
+    def prewarm(self, models: List[str]) -> None:
+        for model in models:
+            with timed("llm_load"), self._slot(model):
+                self.load_model(model)
+
     def is_alive(self) -> bool:
         try:
-            r = requests.get(f"{self.base_url}/api/tags", timeout=10)
+            r = self.session.get(f"{self.base_url}/api/tags", timeout=10)
             return r.ok
         except Exception:
             return False
+
+
+_shared: Optional[OllamaClient] = None
+_shared_lock = threading.Lock()
+
+
+def get_client() -> OllamaClient:
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                client = OllamaClient()
+                if MODEL_SCHEDULER:
+                    client.scheduler = ModelScheduler(on_evict=client.unload_model)
+                _shared = client
+    return _shared
@@ -0,0 +1,256 @@
+import os
+import math
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+import faiss
+import numpy as np
+
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat").lower()
+IVF_NLIST = int(os.getenv("IVF_NLIST", 0))
+IVF_NPROBE = os.getenv("IVF_NPROBE")
+PQ_M = int(os.getenv("PQ_M", 64))
+PQ_NBITS = int(os.getenv("PQ_NBITS", 8))
+HNSW_M = int(os.getenv("HNSW_M", 32))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF_SEARCH = os.getenv("HNSW_EF_SEARCH")
+TRAIN_SAMPLE = int(os.getenv("INDEX_TRAIN_SAMPLE", 100000))
+INDEX_STORAGE = os.getenv("INDEX_STORAGE", "float32").lower()
+INDEX_RESCORE = os.getenv("INDEX_RESCORE", "off").lower() in ("1", "on", "true", "yes")
+INDEX_MMAP = os.getenv("INDEX_MMAP", "on").lower() not in ("0", "off", "false", "no")
+FILTER_SCAN_LIMIT = int(os.getenv("FILTER_SCAN_LIMIT", 10000))
+ADD_BATCH = 65536
+SCAN_BLOCK = 8192
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+STORAGE_TYPES = ("float32", "fp16", "sq8", "pq")
+CODECS = {"float32": "Flat", "fp16": "SQfp16", "sq8": "SQ8"}
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+
+
+def auto_nlist(n: int) -> int:
+    nlist = int(4 * math.sqrt(max(n, 1)))
+    return max(1, min(nlist, n // 39 or 1))
+
+
+def pq_m(dim: int) -> int:
+    m = PQ_M
+    while dim % m:
+        m -= 1
+    return m
+
+
+def storage_of(cfg: Dict) -> str:
+    return cfg.get("storage") or ("pq" if cfg.get("type") == "ivf_pq" else "float32")
+
+
+def index_config(n: int, dim: int, kind: str = INDEX_TYPE, storage: str = INDEX_STORAGE) -> Dict:
+    if kind not in INDEX_TYPES:
+        raise SystemExit(f"Unknown INDEX_TYPE '{kind}'. Choose one of: {', '.join(INDEX_TYPES)}")
+    if storage not in STORAGE_TYPES:
+        raise SystemExit(f"Unknown INDEX_STORAGE '{storage}'. Choose one of: {', '.join(STORAGE_TYPES)}")
+    if kind == "ivf_pq":
+        storage = "pq"
+    cfg: Dict = {"type": kind, "metric": "ip"}
+    if kind in ("ivf_flat", "ivf_pq"):
+        cfg["nlist"] = IVF_NLIST or auto_nlist(n)
+        cfg["nprobe"] = int(IVF_NPROBE) if IVF_NPROBE else DEFAULT_NPROBE
+    if storage == "pq":
+        cfg["pq_m"] = pq_m(dim)
+        cfg["pq_nbits"] = PQ_NBITS
+        if n < 2 ** PQ_NBITS:
+            if kind == "ivf_pq":
+                print(f"WARN: {n} vectors are too few to train PQ codebooks. Falling back to ivf_flat.")
+                cfg = {"type": "ivf_flat", "metric": "ip", "nlist": cfg["nlist"], "nprobe": cfg["nprobe"]}
+                storage = "float32"
+            else:
+                print(f"WARN: {n} vectors are too few to train PQ codebooks. Falling back to sq8 storage.")
+                del cfg["pq_m"], cfg["pq_nbits"]
+                storage = "sq8"
+    if kind == "hnsw":
+        cfg["hnsw_m"] = HNSW_M
+        cfg["ef_construction"] = HNSW_EF_CONSTRUCTION
+        cfg["ef_search"] = int(HNSW_EF_SEARCH) if HNSW_EF_SEARCH else DEFAULT_EF_SEARCH
+    cfg["storage"] = storage
+    # exact re-scoring only makes sense when the index holds lossy codes
+    cfg["rescore"] = INDEX_RESCORE and storage != "float32"
+    cfg["mmap"] = INDEX_MMAP
+    return cfg
+
+
+def bytes_per_vector(cfg: Dict, dim: int) -> float:
+    storage = storage_of(cfg)
+    if storage == "pq":
+        return cfg["pq_m"] * cfg["pq_nbits"] / 8
+    return dim * {"float32": 4, "fp16": 2, "sq8": 1}[storage]
+
+
+def factory_string(cfg: Dict) -> str:
+    kind = cfg.get("type", "flat")
+    storage = storage_of(cfg)
+    codec = f"PQ{cfg['pq_m']}x{cfg['pq_nbits']}" if storage == "pq" else CODECS[storage]
+    if kind == "flat":
+        return codec
+    if kind in ("ivf_flat", "ivf_pq"):
+        return f"IVF{cfg['nlist']},{codec}"
+    if kind == "hnsw":
+        return f"HNSW{cfg['hnsw_m']}" if storage == "float32" else f"HNSW{cfg['hnsw_m']}_{codec}"
+    raise ValueError(f"Unknown index type: {kind}")
+
+
+def new_index(dim: int, cfg: Dict):
+    index = faiss.index_factory(dim, factory_string(cfg), faiss.METRIC_INNER_PRODUCT)
+    if cfg.get("type") == "hnsw":
+        faiss.downcast_index(index).hnsw.efConstruction = cfg["ef_construction"]
+    return index
+
+
+def train_index(index, vecs: np.ndarray, sample: int = TRAIN_SAMPLE) -> None:
+    if index.is_trained:
+        return
+    if len(vecs) > sample:
+        rng = np.random.default_rng(0)
+        vecs = vecs[np.sort(rng.choice(len(vecs), sample, replace=False))]
+    index.train(np.ascontiguousarray(vecs, dtype="float32"))
+
+
+def build_index(vecs: np.ndarray, cfg: Dict):
+    index = new_index(vecs.shape[1], cfg)
+    train_index(index, vecs)
+    for start in range(0, len(vecs), ADD_BATCH):
+        index.add(np.ascontiguousarray(vecs[start:start + ADD_BATCH], dtype="float32"))
+    configure_search(index, cfg)
+    return index
+
+
+def set_search_param(index, kind: str, value: int) -> None:
+    if kind in ("ivf_flat", "ivf_pq"):
+        faiss.extract_index_ivf(index).nprobe = int(value)
+    elif kind == "hnsw":
+        faiss.downcast_index(index).hnsw.efSearch = int(value)
+
+
+def configure_search(index, cfg: Dict) -> None:
+    kind = cfg.get("type", "flat")
+    if kind in ("ivf_flat", "ivf_pq"):
+        set_search_param(index, kind, IVF_NPROBE or cfg.get("nprobe", DEFAULT_NPROBE))
+    elif kind == "hnsw":
+        set_search_param(index, kind, HNSW_EF_SEARCH or cfg.get("ef_search", DEFAULT_EF_SEARCH))
+
+
+def reconstruct_all(index) -> np.ndarray:
+    if isinstance(faiss.downcast_index(index), faiss.IndexIVF):
+        faiss.extract_index_ivf(index).make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def save_index(index, path: Path) -> None:
+    # readers may have the current file memory-mapped, so never rewrite it in place
+    tmp = path.with_name(path.name + ".tmp")
+    faiss.write_index(index, str(tmp))
+    os.replace(tmp, path)
+
+
+def load_index(path: Path, cfg: Dict):
+    """Read an index for searching; with `mmap` in the config its codes stay on disk and are paged in on demand."""
+    if not cfg.get("mmap"):
+        return faiss.read_index(str(path))
+    # IVF lists are mapped via OnDiskInvertedLists; flat, SQ, PQ and HNSW storage via the mmap'd flat codes
+    ivf = cfg.get("type") in ("ivf_flat", "ivf_pq")
+    flag = faiss.IO_FLAG_MMAP if ivf else getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    if not flag:
+        return faiss.read_index(str(path))
+    try:
+        return faiss.read_index(str(path), flag)
+    except RuntimeError as e:
+        print(f"WARN: could not memory-map {path} ({e}). Loading it into RAM.")
+        return faiss.read_index(str(path))
+
+
+def load_vectors(path: Path, dim: int) -> Optional[np.ndarray]:
+    """Float32 sidecar of the original embeddings, row-aligned with the index, mapped read-only."""
+    if not path.exists() or path.stat().st_size == 0:
+        return None
+    return np.memmap(path, dtype="float32", mode="r").reshape(-1, dim)
+
+
+def append_vectors(path: Path, vecs: np.ndarray) -> None:
+    # appending never touches rows a reader has already mapped
+    with open(path, "ab") as f:
+        for start in range(0, len(vecs), ADD_BATCH):
+            f.write(np.ascontiguousarray(vecs[start:start + ADD_BATCH], dtype="float32").tobytes())
+
+
+def save_vectors(path: Path, vecs: np.ndarray) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    append_vectors(tmp, vecs)
+    os.replace(tmp, path)
+
+
+def rescore(vectors: np.ndarray, qvs: np.ndarray, idxs: np.ndarray) -> np.ndarray:
+    """Re-rank approximate search hits by exact inner product against the float32 sidecar."""
+    out = np.full_like(idxs, -1)
+    for r, (q, row) in enumerate(zip(qvs, idxs)):
+        ids = row[(row >= 0) & (row < len(vectors))]
+        if len(ids):
+            scores = np.asarray(vectors[ids]) @ q
+            out[r, :len(ids)] = ids[np.argsort(-scores, kind="stable")]
+    return out
+
+
+_direct_map_lock = threading.Lock()
+
+
+def reconstruct_rows(index, rows: np.ndarray) -> np.ndarray:
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        # filtered searches run concurrently on the shared index; build the map exactly once
+        with _direct_map_lock:
+            if ivf.direct_map.type == faiss.DirectMap.NoMap:
+                ivf.make_direct_map()
+    return index.reconstruct_batch(np.ascontiguousarray(rows, dtype="int64"))
+
+
+def _selector_params(index, sel):
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=sel, nprobe=ivf.nprobe)
+    inner = faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=inner.hnsw.efSearch)
+    return faiss.SearchParameters(sel=sel)
+
+
+def subset_search(index, qvs: np.ndarray, rows: np.ndarray, n: int, vectors: Optional[np.ndarray] = None) -> np.ndarray:
+    """Top-`n` ids among `rows` (sorted) for each query, -1 padded.
+
+    Small subsets are scored exactly from just their own vectors (the float32 sidecar when present), so cost
+    shrinks with the filter. Large ones go through the index with an ID selector.
+    """
+    n = min(n, len(rows))
+    out = np.full((len(qvs), n), -1, dtype="int64")
+    if n == 0:
+        return out
+    if len(rows) > FILTER_SCAN_LIMIT:
+        try:
+            _, idxs = index.search(qvs, n, params=_selector_params(index, faiss.IDSelectorBatch(rows)))
+            return idxs
+        except RuntimeError:
+            pass  # e.g. IndexPQ takes no search parameters; fall back to scanning the subset
+    best_ids = np.zeros((len(qvs), 0), dtype="int64")
+    best_scores = np.zeros((len(qvs), 0), dtype="float32")
+    for start in range(0, len(rows), SCAN_BLOCK):
+        block = rows[start:start + SCAN_BLOCK]
+        sub = np.asarray(vectors[block]) if vectors is not None else reconstruct_rows(index, block)
+        ids = np.concatenate([best_ids, np.broadcast_to(block, (len(qvs), len(block)))], axis=1)
+        scores = np.concatenate([best_scores, qvs @ sub.T], axis=1)
+        if scores.shape[1] > n:
+            keep = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+            ids, scores = np.take_along_axis(ids, keep, 1), np.take_along_axis(scores, keep, 1)
+        best_ids, best_scores = ids, scores
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    out[:, :best_ids.shape[1]] = np.take_along_axis(best_ids, order, 1)
+    return out
@@ -0,0 +1,158 @@
+import json
+import time
+import hashlib
+import argparse
+import threading
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+
+@dataclass
+class FakeConfig:
+    dim: int = 768
+    embed_latency_ms: float = 2.0      # per request
+    embed_per_text_ms: float = 0.5     # per input text
+    prompt_tokens_per_s: float = 2000  # prompt eval speed
+    tokens_per_s: float = 200          # generation speed
+    answer_tokens: int = 40
+    first_token_ms: float = 20.0
+    load_ms: float = 50.0              # first request for a model that is not resident
+    models: tuple = ("llama3.1:8b", "gemma2:9b", "mistral:7b")
+
+
+def fake_vector(text: str, dim: int) -> list:
+    seed = int(hashlib.sha1(text.encode("utf-8", errors="ignore")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype("float32").tolist()
+
+
+def fake_answer(model: str, messages: list, n_tokens: int) -> list:
+    last = messages[-1]["content"] if messages else ""
+    seed = int(hashlib.sha1((model + last).encode("utf-8", errors="ignore")).hexdigest()[:8], 16)
+    words = ["MODIS", "Terra", "radiance", "band", "calibration", "orbit", "surface", "reflectance", "the", "of"]
+    rng = np.random.default_rng(seed)
+    return [words[i] + " " for i in rng.integers(0, len(words), n_tokens)]
+
+
+def make_handler(cfg: FakeConfig):
+    resident = set()  # models "loaded" by a chat or generate request and not unloaded since
+    lock = threading.Lock()
+
+    def load(model: str) -> float:
+        """Seconds spent loading `model` (0 if it was resident)."""
+        with lock:
+            if model in resident:
+                return 0.0
+            resident.add(model)
+        time.sleep(cfg.load_ms / 1000)
+        return cfg.load_ms / 1000
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, obj, code=200):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _chunk(self, obj):
+            line = (json.dumps(obj) + "\n").encode()
+            self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path == "/api/tags":
+                return self._send({"models": [{"name": m, "model": m} for m in cfg.models]})
+            if self.path == "/api/ps":
+                with lock:
+                    return self._send({"models": [{"name": m, "model": m} for m in sorted(resident)]})
+            self._send({"error": "not found"}, 404)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path == "/api/embeddings":
+                time.sleep((cfg.embed_latency_ms + cfg.embed_per_text_ms) / 1000)
+                return self._send({"embedding": fake_vector(body.get("prompt", ""), cfg.dim)})
+            if self.path == "/api/embed":
+                texts = body.get("input", [])
+                texts = [texts] if isinstance(texts, str) else texts
+                time.sleep((cfg.embed_latency_ms + cfg.embed_per_text_ms * len(texts)) / 1000)
+                return self._send({"embeddings": [fake_vector(t, cfg.dim) for t in texts]})
+            if self.path == "/api/chat":
+                return self._chat(body)
+            if self.path == "/api/generate":
+                return self._generate(body)
+            self._send({"error": "not found"}, 404)
+
+        def _generate(self, body):
+            # only the prompt-less form is used: load a model, or unload it with keep_alive=0
+            model = body.get("model", "")
+            if body.get("keep_alive") in (0, "0", "0s"):
+                with lock:
+                    resident.discard(model)
+                return self._send({"model": model, "response": "", "done": True, "done_reason": "unload"})
+            load(model)
+            self._send({"model": model, "response": "", "done": True, "done_reason": "load"})
+
+        def _chat(self, body):
+            model = body.get("model", "")
+            messages = body.get("messages", [])
+            load_s = load(model)
+            prompt_tokens = sum(len(m.get("content", "")) for m in messages) // 4
+            prompt_s = cfg.first_token_ms / 1000 + prompt_tokens / cfg.prompt_tokens_per_s
+            time.sleep(prompt_s)
+            pieces = fake_answer(model, messages, cfg.answer_tokens)
+            per_token = 1.0 / cfg.tokens_per_s
+            eval_s = per_token * len(pieces)
+            # durations in ns, as Ollama reports them in the final response
+            stats = {"done": True, "prompt_eval_count": prompt_tokens, "eval_count": len(pieces),
+                     "load_duration": int(load_s * 1e9), "prompt_eval_duration": int(prompt_s * 1e9),
+                     "eval_duration": int(eval_s * 1e9), "total_duration": int((load_s + prompt_s + eval_s) * 1e9)}
+            if not body.get("stream"):
+                time.sleep(eval_s)
+                return self._send({"model": model, "message": {"role": "assistant", "content": "".join(pieces)}, **stats})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for piece in pieces:
+                time.sleep(per_token)
+                self._chunk({"model": model, "message": {"role": "assistant", "content": piece}, "done": False})
+            self._chunk({"model": model, "message": {"role": "assistant", "content": ""}, **stats})
+            self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+def start_fake_ollama(cfg: FakeConfig = None, host: str = "127.0.0.1", port: int = 0):
+    """Serve the fake API from a daemon thread. Returns (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), make_handler(cfg or FakeConfig()))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Deterministic stand-in for the Ollama API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=11435)
+    defaults = FakeConfig()
+    for name in ("dim", "embed_latency_ms", "embed_per_text_ms", "prompt_tokens_per_s", "tokens_per_s", "answer_tokens", "first_token_ms", "load_ms"):
+        value = getattr(defaults, name)
+        ap.add_argument("--" + name.replace("_", "-"), type=type(value), default=value)
+    args = ap.parse_args()
+    cfg = FakeConfig(**{k: v for k, v in vars(args).items() if k not in ("host", "port")})
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(cfg))
+    print(f"Fake Ollama on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
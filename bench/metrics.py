@@ -0,0 +1,91 @@
+import os
+import json
+import resource
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# metric -> True when a larger value is better
+TRACKED = {"p50_ms": False, "p95_ms": False, "p99_ms": False, "throughput": True, "peak_rss_mb": False}
+
+
+def summarize(latencies_s: List[float], wall_s: float, peak_rss_mb: Optional[float] = None, **extra) -> Dict:
+    lat = np.asarray(latencies_s, dtype="float64") * 1000
+    out = {
+        "n": int(len(lat)),
+        "wall_s": round(wall_s, 3),
+        "throughput": round(len(lat) / wall_s, 3) if wall_s > 0 else 0.0,
+        "p50_ms": round(float(np.percentile(lat, 50)), 2) if len(lat) else None,
+        "p95_ms": round(float(np.percentile(lat, 95)), 2) if len(lat) else None,
+        "p99_ms": round(float(np.percentile(lat, 99)), 2) if len(lat) else None,
+        "peak_rss_mb": round(peak_rss_mb, 1) if peak_rss_mb is not None else None,
+    }
+    out.update(extra)
+    return out
+
+
+def self_peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rusage_peak_rss_mb(ru) -> float:
+    return ru.ru_maxrss / 1024
+
+
+def proc_peak_rss_mb(pid: int) -> Optional[float]:
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def load_results(path: Path) -> Optional[Dict]:
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def save_results(path: Path, results: Dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float) -> List[Dict]:
+    """One row per scenario/metric present in both runs; `regression` is set when worse than tolerance."""
+    rows = []
+    for name, cur in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for metric, higher_better in TRACKED.items():
+            c, b = cur.get(metric), base.get(metric)
+            if c is None or not b:
+                continue
+            change = (c - b) / b
+            worse = -change if higher_better else change
+            rows.append({"scenario": name, "metric": metric, "baseline": b, "current": c,
+                         "change": round(change, 4), "regression": worse > tolerance})
+    return rows
+
+
+def print_results(results: Dict) -> None:
+    print(f"\n{'scenario':<16}{'n':>6}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak MB':>10}")
+    for name, r in results["scenarios"].items():
+        cells = [r.get("throughput"), r.get("p50_ms"), r.get("p95_ms"), r.get("p99_ms"), r.get("peak_rss_mb")]
+        print(f"{name:<16}{r['n']:>6}" + "".join(f"{'-' if v is None else v:>10}" for v in cells))
+
+
+def print_comparison(rows: List[Dict], tolerance: float) -> None:
+    if not rows:
+        print("\nNo overlapping scenarios with the baseline.")
+        return
+    print(f"\nAgainst baseline (tolerance {tolerance:.0%}):")
+    for r in rows:
+        flag = "REGRESSION" if r["regression"] else ""
+        print(f"  {r['scenario']:<16}{r['metric']:<13}{r['baseline']:>10} -> {r['current']:<10}{r['change']:+8.1%}  {flag}")
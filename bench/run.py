@@ -0,0 +1,328 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import requests
+
+from bench.fake_ollama import FakeConfig, start_fake_ollama
+from bench.metrics import (summarize, self_peak_rss_mb, rusage_peak_rss_mb, proc_peak_rss_mb,
+                           load_results, save_results, compare, print_results, print_comparison)
+
+ROOT = Path(__file__).resolve().parents[1]
+SCENARIOS = ("ingest", "incremental", "retrieve", "search", "ask_off", "ask_router", "ask_consensus", "stream", "load",
+             "import_query", "import_cli", "import_server")
+IMPORT_SCENARIOS = {"import_query": "app.query", "import_cli": "app.cli", "import_server": "app.server"}
+# ingest, OCR and summarizer dependencies; the query entry points must not load them at import time
+INGEST_ONLY_MODULES = ("pypdf", "pytesseract", "pdf2image", "tqdm", "bs4", "ollama")
+MODELS = ["llama3.1:8b", "gemma2:9b", "mistral:7b"]
+
+QUESTIONS = [
+    "What does MODIS measure on the Terra satellite?",
+    "How are the thermal emissive bands calibrated?",
+    "What is the orbit of the Terra spacecraft?",
+    "Explain the MODIS land data processing chain.",
+    "Which bands are used for shortwave infrared retrievals?",
+    "How is on-orbit radiometric stability monitored?",
+    "What pre-processing steps are applied to MODIS data?",
+    "How long has the Terra mission been operating?",
+    "What is surface reflectance and how is it derived?",
+    "How does the solar diffuser support calibration?",
+    "What limits the accuracy of SWIR band measurements?",
+    "Describe the Morning Constellation.",
+]
+
+
+def questions(n: int) -> List[str]:
+    return [QUESTIONS[i % len(QUESTIONS)] for i in range(n)]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def bench_env(work: Path, ollama_url: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "OLLAMA_HOST": ollama_url,
+        "STORE_DIR": str(work / "store"),
+        "EMBED_CACHE_DIR": str(work / "cache" / "embeddings"),
+        "OCR_CACHE_DIR": str(work / "cache" / "ocr"),
+        "OCR_MODE": env.get("OCR_MODE", "off"),
+        "ANSWER_CACHE": "off",
+        "QUERY_EMBED_CACHE_SIZE": "0",
+        "LLM_MODEL": MODELS[0],
+        "LLM_MODELS": ",".join(MODELS),
+        "JUDGE_MODEL": MODELS[0],
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(ROOT), env.get("PYTHONPATH")])),
+    })
+    return env
+
+
+def run_module(module: str, work: Path, env: Dict[str, str]):
+    log = work / f"{module}.log"
+    start = time.perf_counter()
+    with open(log, "wb") as err:
+        proc = subprocess.Popen([sys.executable, "-m", module], cwd=work, env=env, stdout=subprocess.DEVNULL, stderr=err)
+        # wait4 gives this child's own peak RSS, not the max over every child so far
+        _, status, ru = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{module} failed:\n{log.read_text(errors='replace')[-2000:]}")
+    return wall, rusage_peak_rss_mb(ru)
+
+
+def vector_count(work: Path) -> int:
+    store = work / "store"
+    current = store / "CURRENT"
+    if current.exists():
+        store = store / "generations" / current.read_text(encoding="utf-8").strip()
+    return json.loads((store / "manifest.json").read_text(encoding="utf-8")).get("vector_count", 0)
+
+
+def bench_ingest(work: Path, env: Dict[str, str], pdfs: List[Path]) -> Dict:
+    for pdf in pdfs[:-1]:
+        shutil.copy2(pdf, work / "data" / pdf.name)
+    wall, rss = run_module("app.ingest", work, env)
+    n = vector_count(work)
+    return summarize([wall], wall, rss, pdfs=len(pdfs) - 1, chunks=n, chunks_per_s=round(n / wall, 1))
+
+
+def bench_incremental(work: Path, env: Dict[str, str], pdfs: List[Path]) -> Dict:
+    before = vector_count(work)
+    shutil.copy2(pdfs[-1], work / "data" / pdfs[-1].name)
+    wall, rss = run_module("app.incremental_ingest", work, env)
+    n = vector_count(work) - before
+    return summarize([wall], wall, rss, pdfs=1, chunks=n, chunks_per_s=round(n / wall, 1))
+
+
+def timed(fn, items, concurrency: int = 1):
+    def one(item):
+        t = time.perf_counter()
+        fn(item)
+        return time.perf_counter() - t
+
+    start = time.perf_counter()
+    if concurrency <= 1:
+        lat = [one(item) for item in items]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            lat = list(pool.map(one, items))
+    return lat, time.perf_counter() - start
+
+
+def bench_retrieval(env: Dict[str, str], n: int, k: int) -> Dict[str, Dict]:
+    # app modules read their settings at import time, so point them at the bench store first
+    os.environ.update(env)
+    from app.query import retrieve, search, embed_query
+    from app.store import get_store
+    from app.utils.ollama_client import get_client
+
+    get_store()
+    client = get_client()
+    qs = questions(n)
+    lat, wall = timed(lambda q: retrieve(q, client, k=k), qs)
+    out = {"retrieve": summarize(lat, wall, self_peak_rss_mb())}
+    qvs = {q: embed_query(q, client) for q in set(qs)}
+    lat, wall = timed(lambda q: search(q, qvs[q], k), qs)
+    out["search"] = summarize(lat, wall, self_peak_rss_mb())
+    return out
+
+
+def import_time(module: str, work: Path, env: Dict[str, str]) -> Tuple[float, List[str]]:
+    """Cold import of `module` in a fresh interpreter: (seconds, ingest-only modules it pulled in)."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=work, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    seconds, loaded = 0.0, set()
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        loaded.add(name.split(".")[0])
+        if name == module:
+            seconds = int(parts[1]) / 1e6
+    return seconds, sorted(loaded & set(INGEST_ONLY_MODULES))
+
+
+def bench_imports(work: Path, env: Dict[str, str], wanted: List[str], runs: int) -> Dict[str, Dict]:
+    out = {}
+    for name, module in IMPORT_SCENARIOS.items():
+        if name in wanted:
+            results = [import_time(module, work, env) for _ in range(runs)]
+            lat = [sec for sec, _ in results]
+            out[name] = summarize(lat, sum(lat), module=module, ingest_only_modules=results[0][1])
+    return out
+
+
+def start_server(work: Path, env: Dict[str, str]):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.server:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=work, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("app.server exited during startup")
+        try:
+            requests.get(url + "/cache/stats", timeout=1).raise_for_status()
+            return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("app.server did not start within 120s")
+
+
+def bench_server(work: Path, env: Dict[str, str], wanted: List[str], n: int, k: int,
+                 concurrency: int, load_requests: int) -> Dict[str, Dict]:
+    proc, url = start_server(work, env)
+    session = requests.Session()
+    out = {}
+
+    def ask(mode):
+        def call(q):
+            r = session.post(url + "/ask", json={"question": q, "top_k": k, "mode": mode}, timeout=600)
+            r.raise_for_status()
+        return call
+
+    def first_token(q):
+        with session.post(url + "/ask/stream", json={"question": q, "top_k": k, "mode": "off"}, stream=True, timeout=600) as r:
+            r.raise_for_status()
+            t = None
+            for line in r.iter_lines():
+                if t is None and line == b"event: token":
+                    t = time.perf_counter()
+            return t
+
+    try:
+        for mode in ("off", "router", "consensus"):
+            if f"ask_{mode}" in wanted:
+                lat, wall = timed(ask(mode), questions(n))
+                out[f"ask_{mode}"] = summarize(lat, wall, proc_peak_rss_mb(proc.pid))
+        if "stream" in wanted:
+            ttft = []
+            start = time.perf_counter()
+            for q in questions(n):
+                t0 = time.perf_counter()
+                t = first_token(q)
+                ttft.append((t or time.perf_counter()) - t0)
+            out["stream"] = summarize(ttft, time.perf_counter() - start, proc_peak_rss_mb(proc.pid), metric="time_to_first_token")
+        if "load" in wanted:
+            lat, wall = timed(ask("off"), questions(load_requests), concurrency=concurrency)
+            out["load"] = summarize(lat, wall, proc_peak_rss_mb(proc.pid), concurrency=concurrency)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="End-to-end benchmarks against a local fake Ollama")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    ap.add_argument("--data", type=Path, default=ROOT / "data", help="directory of PDFs to ingest")
+    ap.add_argument("--pdfs", type=int, default=0, help="use only the first N PDFs (0 = all); the last one is held back for incremental")
+    ap.add_argument("--queries", type=int, default=50)
+    ap.add_argument("--top-k", type=int, default=5)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--load-requests", type=int, default=200)
+    ap.add_argument("--out", type=Path, default=ROOT / "bench" / "results" / "latest.json")
+    ap.add_argument("--baseline", type=Path, default=ROOT / "bench" / "baseline.json")
+    ap.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown before a metric is a regression")
+    ap.add_argument("--keep", action="store_true", help="keep the temporary work directory")
+    ap.add_argument("--import-time", action="store_true", help="only measure cold import time of the query entry points")
+    ap.add_argument("--import-runs", type=int, default=5, help="fresh interpreters per import scenario")
+    defaults = FakeConfig()
+    for name in ("embed_latency_ms", "embed_per_text_ms", "prompt_tokens_per_s", "tokens_per_s", "answer_tokens", "first_token_ms",
+                 "load_ms"):
+        value = getattr(defaults, name)
+        ap.add_argument("--" + name.replace("_", "-"), type=type(value), default=value)
+    args = ap.parse_args()
+
+    wanted = list(IMPORT_SCENARIOS) if args.import_time else [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(wanted) - set(SCENARIOS)
+    if unknown:
+        ap.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    pdfs = sorted(args.data.glob("*.pdf"))
+    if args.pdfs:
+        pdfs = pdfs[:args.pdfs]
+    if len(pdfs) < 2 and set(wanted) - set(IMPORT_SCENARIOS):
+        ap.error(f"need at least 2 PDFs in {args.data}")
+
+    cfg = FakeConfig(**{k: getattr(args, k) for k in ("embed_latency_ms", "embed_per_text_ms", "prompt_tokens_per_s",
+                                                      "tokens_per_s", "answer_tokens", "first_token_ms", "load_ms")},
+                     models=tuple(MODELS))
+    server, ollama_url = start_fake_ollama(cfg)
+    work = Path(tempfile.mkdtemp(prefix="pdfqa-bench-"))
+    (work / "data").mkdir()
+    env = bench_env(work, ollama_url)
+    scenarios: Dict[str, Dict] = {}
+    try:
+        if set(IMPORT_SCENARIOS) & set(wanted):
+            print(f"Import time x{args.import_runs} ...")
+            scenarios.update(bench_imports(work, env, wanted, args.import_runs))
+        if set(wanted) - set(IMPORT_SCENARIOS):
+            # every other scenario needs the store, so ingest always runs
+            print(f"Ingesting {len(pdfs) - 1} PDFs into {work} ...")
+            scenarios["ingest"] = bench_ingest(work, env, pdfs)
+        if "incremental" in wanted:
+            print("Incremental ingest of 1 PDF ...")
+            scenarios["incremental"] = bench_incremental(work, env, pdfs)
+        if {"retrieve", "search"} & set(wanted):
+            print(f"Retrieval x{args.queries} ...")
+            scenarios.update({k: v for k, v in bench_retrieval(env, args.queries, args.top_k).items() if k in wanted})
+        if {"ask_off", "ask_router", "ask_consensus", "stream", "load"} & set(wanted):
+            print("Server scenarios ...")
+            scenarios.update(bench_server(work, env, wanted, args.queries, args.top_k, args.concurrency, args.load_requests))
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"Work directory kept at {work}")
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "fake_ollama": {k: v for k, v in vars(cfg).items() if k != "models"},
+        "scenarios": {name: scenarios[name] for name in SCENARIOS if name in scenarios},
+    }
+    print_results(results)
+    for name in IMPORT_SCENARIOS:
+        if scenarios.get(name, {}).get("ingest_only_modules"):
+            print(f"Warning: {IMPORT_SCENARIOS[name]} imports {', '.join(scenarios[name]['ingest_only_modules'])}")
+    save_results(args.out, results)
+    print(f"\nResults written to {args.out}")
+
+    if args.save_baseline:
+        save_results(args.baseline, results)
+        print(f"Baseline saved to {args.baseline}")
+        return
+    baseline = load_results(args.baseline)
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one.")
+        return
+    if baseline.get("fake_ollama") != results["fake_ollama"]:
+        print("Warning: baseline was recorded with different fake Ollama settings; latencies are not comparable.")
+    rows = compare(results, baseline, args.tolerance)
+    print_comparison(rows, args.tolerance)
+    if any(r["regression"] for r in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import time
+import threading
+from concurrent import futures
+from contextlib import nullcontext
+
+import numpy as np
+import pytest
+
+from app import batch, query_multi
+from app.query import Retrieval, NO_MATCH
+from app.scheduler import ModelScheduler
+
+MODELS = ["m1", "m2", "m3"]
+
+
+class StubClient:
+    def __init__(self):
+        self.calls = []
+        self.scheduler = None
+        self._lock = threading.Lock()
+
+    def chat(self, model, messages, timeout=600, abort=None, on_reply=None):
+        with self.scheduler.slot(model, abort) if self.scheduler else nullcontext():
+            with self._lock:
+                self.calls.append(model)
+            time.sleep(0.01)
+            answer = f"{model}: {messages[-1]['content'][:40]}"
+            if on_reply is not None:
+                on_reply(answer)
+            return answer
+
+
+class NoCache:
+    def get(self, scope, question):
+        return None
+
+    def get_similar(self, scope, qvec):
+        return None
+
+    def put(self, scope, question, qvec, value):
+        pass
+
+
+def stub_retrieval(question, k, qv, chunks, ids, filters=None):
+    messages = [{"role": "system", "content": "system"}, {"role": "user", "content": question}]
+    return Retrieval(question, k, qv, chunks, ids, messages, [], {}, filters)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = StubClient()
+    monkeypatch.setattr(batch, "get_client", lambda: client)
+    monkeypatch.setattr(batch, "answer_cache", NoCache())
+    monkeypatch.setattr(batch, "answer_scope", lambda mode, k, models, judge_model=None, filters=None: (mode, tuple(models)))
+    monkeypatch.setattr(batch, "embed_queries", lambda questions, c: np.ones((len(questions), 4), dtype="float32"))
+    monkeypatch.setattr(batch, "search_many",
+                        lambda questions, qvs, k, filters=None: [([] if filters else [{"text": q}], []) for q in questions])
+    monkeypatch.setattr(batch, "build_retrieval", stub_retrieval)
+    monkeypatch.setattr(query_multi, "agreed_candidate", lambda c, candidates: (None, None))
+    return client
+
+
+def settled_wait(fs, return_when):
+    # let every in-flight generation finish first, so one wait() hands back several candidates of the same question
+    futures.wait(fs, timeout=5)
+    return futures.wait(fs, return_when=return_when)
+
+
+def test_consensus_skips_candidates_dropped_by_the_judge(client, monkeypatch):
+    monkeypatch.setattr(batch, "wait", settled_wait)
+    questions = [f"question {i}?" for i in range(12)]
+    results = list(batch.ask_batch(questions, mode="consensus", models=MODELS, judge_model="m1", concurrency=16))
+    assert sorted(r["question"] for r in results) == sorted(questions)
+    assert not [r for r in results if "error" in r]
+    assert all(r["judge_model"] == "m1" and r["judge_ran"] for r in results)
+
+
+def test_consensus_candidates_past_quorum_never_run(client):
+    client.scheduler = ModelScheduler(max_loaded=1)
+    [res] = batch.ask_batch(["question?"], mode="consensus", models=MODELS, judge_model="m1", concurrency=3)
+    assert [c["status"] for c in res["candidates"]] == ["ok", "ok", "skipped"]
+    assert client.calls == ["m1", "m2", "m1"]  # two candidates, then the judge
+    assert client.scheduler.stats()["waiting"] == []
+
+
+def test_repeated_questions_share_one_generation(client):
+    results = list(batch.ask_batch(["What is MODIS?", "what is  MODIS?", "Other?"], mode="off", concurrency=2))
+    assert sorted(r["id"] for r in results) == [0, 1, 2]
+    assert len(client.calls) == 2
+
+
+def test_filter_without_matches_skips_the_models(client):
+    results = list(batch.ask_batch(["a?", "b?"], mode="consensus", models=MODELS, judge_model="m1",
+                                   filters={"docs": ["nope*"]}))
+    assert [r["answer"] for r in results] == [NO_MATCH, NO_MATCH]
+    assert client.calls == []
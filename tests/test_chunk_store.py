@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+from app.chunk_store import ChunkStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = tmp_path / "chunks.jsonl"
+    rows = [{"uid": n, "text": f"chunk {n} " + "é" * n} for n in range(6)]
+    path.write_text("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows), encoding="utf-8")
+    store = ChunkStore(path)
+    yield store
+    store.close()
+
+
+def test_get_many_keeps_the_requested_order(store):
+    ids = [4, 0, 5, 4, 2]
+    assert store.get_many(ids) == [store[i] for i in ids]
+    assert [c["uid"] for c in store.get_many(ids)] == ids
+    assert store.get_many([]) == []
+
+
+def test_get_many_rejects_out_of_range_ids(store):
+    with pytest.raises(IndexError):
+        store.get_many([1, 6])
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+from app.query import Retrieval
+from app.query_multi import generate_candidates, agenerate_candidates, settle
+
+MODELS = ["m1", "m2", "m3"]
+MESSAGES = [{"role": "user", "content": "q"}]
+
+
+class SlowClient:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.scheduler = None
+
+    def chat(self, model, messages, timeout=600, abort=None, on_reply=None):
+        time.sleep(min(self.delay, timeout))
+        if self.delay > timeout:
+            raise TimeoutError(f"{model} timed out")
+        if on_reply is not None:
+            on_reply(model)
+        return model
+
+    async def achat(self, model, messages, timeout=600):
+        await asyncio.sleep(self.delay)
+        return model
+
+
+def test_queued_candidates_share_one_deadline():
+    t0 = time.perf_counter()
+    candidates = generate_candidates(SlowClient(0.3), MODELS, MESSAGES, timeout=0.5, concurrency=1, quorum=3)
+    assert time.perf_counter() - t0 < 0.7
+    assert [c["status"] for c in candidates] == ["ok", "timeout", "timeout"]
+
+
+def test_async_queued_candidates_share_one_deadline():
+    t0 = time.perf_counter()
+    candidates = asyncio.run(agenerate_candidates(SlowClient(0.3), MODELS, MESSAGES, timeout=0.5, concurrency=1, quorum=3))
+    assert time.perf_counter() - t0 < 0.7
+    assert [c["status"] for c in candidates] == ["ok", "timeout", "timeout"]
+
+
+class EmbedClient:
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_many(self, texts, model):
+        return np.array([self.vectors[t] for t in texts], dtype="float32")
+
+
+def retrieval():
+    messages = [{"role": "system", "content": "system"}, {"role": "user", "content": "Question: q\n\nContext blocks:"}]
+    return Retrieval("q", 5, np.zeros(4, dtype="float32"), [], [], messages, [], {})
+
+
+def candidate(model, answer, status="ok"):
+    return {"model": model, "answer": answer, "latency_ms": 1.0, "status": status}
+
+
+def test_settle_skips_the_judge_when_candidates_agree():
+    client = EmbedClient({"a": [1, 0, 0, 0], "b": [1, 0.01, 0, 0]})
+    verdict = settle(client, retrieval(), [candidate("m1", "a"), candidate("m2", "b"), candidate("m3", "", "skipped")], "judge")
+    assert verdict.judge_messages is None and verdict.answer in ("a", "b")
+    assert verdict.fields["judge_ran"] is False
+    assert verdict.done_event() == {"type": "done", "model": verdict.fields["model"], "judge_ran": False}
+
+
+def test_settle_judges_disagreeing_candidates():
+    client = EmbedClient({"a": [1, 0, 0, 0], "b": [0, 1, 0, 0]})
+    verdict = settle(client, retrieval(), [candidate("m1", "a"), candidate("m2", "b")], "judge")
+    assert verdict.answer is None and "[Candidate 2 — m2]" in verdict.judge_messages[-1]["content"]
+    assert verdict.done_event() == {"type": "done", "model": "judge", "judge_ran": True}
+
+
+def test_settle_raises_when_no_candidate_answered():
+    with pytest.raises(RuntimeError):
+        settle(EmbedClient({}), retrieval(), [candidate("m1", "", "timeout"), candidate("m2", "", "error")], "judge")
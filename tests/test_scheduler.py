@@ -0,0 +1,165 @@
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+from app.scheduler import ModelScheduler
+from app.query_multi import generate_candidates
+
+TIMEOUT = 5
+
+
+class Holder:
+    """Takes a slot for `model` on its own thread and keeps it until `leave()`."""
+
+    def __init__(self, scheduler: ModelScheduler, model: str, abort: threading.Event = None):
+        self.entered = threading.Event()
+        self._leave = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(scheduler, model, abort), daemon=True)
+        self.thread.start()
+
+    def _run(self, scheduler, model, abort):
+        try:
+            with scheduler.slot(model, abort):
+                self.entered.set()
+                self._leave.wait(TIMEOUT)
+        except Exception as e:
+            self.error = e
+
+    def leave(self):
+        self._leave.set()
+        self.thread.join(TIMEOUT)
+
+
+def until(predicate):
+    deadline = time.monotonic() + TIMEOUT
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def evicted():
+    return []
+
+
+def scheduler(evicted, **kw):
+    return ModelScheduler(on_evict=evicted.append, **kw)
+
+
+def test_swap_waits_for_the_loaded_model_and_unloads_it(evicted):
+    s = scheduler(evicted, max_loaded=1)
+    a = Holder(s, "a")
+    assert a.entered.wait(TIMEOUT)
+    b = Holder(s, "b")
+    until(lambda: s.stats()["waiting"] == ["b"])
+    assert not b.entered.is_set()
+    a.leave()
+    assert b.entered.wait(TIMEOUT)
+    b.leave()
+    assert evicted == ["a"]
+    assert (s.loads, s.evictions) == (2, 1)
+
+
+def test_loaded_model_goes_before_a_swap(evicted):
+    s = scheduler(evicted, max_loaded=1, batch=8)
+    a1 = Holder(s, "a")
+    assert a1.entered.wait(TIMEOUT)
+    b = Holder(s, "b")
+    until(lambda: s.stats()["waiting"] == ["b"])
+    a2 = Holder(s, "a")
+    assert a2.entered.wait(TIMEOUT)
+    a1.leave()
+    assert not b.entered.is_set()
+    a2.leave()
+    assert b.entered.wait(TIMEOUT)
+    b.leave()
+
+
+def test_loaded_model_yields_after_its_batch(evicted):
+    s = scheduler(evicted, max_loaded=1, batch=1)
+    a1 = Holder(s, "a")
+    assert a1.entered.wait(TIMEOUT)
+    b = Holder(s, "b")
+    until(lambda: s.stats()["waiting"] == ["b"])
+    a2 = Holder(s, "a")  # first request while b waits: still within the batch
+    assert a2.entered.wait(TIMEOUT)
+    a3 = Holder(s, "a")
+    until(lambda: s.stats()["waiting"] == ["b", "a"])
+    a1.leave()
+    a2.leave()
+    assert b.entered.wait(TIMEOUT)
+    assert not a3.entered.is_set()
+    b.leave()
+    assert a3.entered.wait(TIMEOUT)
+    a3.leave()
+    assert evicted == ["a", "b"]
+
+
+def test_least_recently_used_idle_model_is_evicted(evicted):
+    s = scheduler(evicted, max_loaded=2)
+    for model in ("a", "b"):
+        h = Holder(s, model)
+        assert h.entered.wait(TIMEOUT)
+        h.leave()
+    c = Holder(s, "c")
+    assert c.entered.wait(TIMEOUT)
+    c.leave()
+    assert evicted == ["a"]
+    assert set(s.stats()["loaded"]) == {"b", "c"}
+
+
+def test_slot_cap_limits_requests_per_model(evicted):
+    s = scheduler(evicted, max_loaded=1, slots=1)
+    a1 = Holder(s, "a")
+    assert a1.entered.wait(TIMEOUT)
+    a2 = Holder(s, "a")
+    until(lambda: s.stats()["waiting"] == ["a"])
+    a1.leave()
+    assert a2.entered.wait(TIMEOUT)
+    a2.leave()
+
+
+def test_abort_withdraws_a_queued_request(evicted):
+    s = scheduler(evicted, max_loaded=1)
+    a = Holder(s, "a")
+    assert a.entered.wait(TIMEOUT)
+    abort = threading.Event()
+    b = Holder(s, "b", abort)
+    until(lambda: s.stats()["waiting"] == ["b"])
+    abort.set()
+    b.thread.join(TIMEOUT)
+    assert isinstance(b.error, CancelledError)
+    assert not b.entered.is_set()
+    assert s.stats()["waiting"] == []
+    a.leave()
+    assert (s.loads, evicted) == (1, [])
+
+
+class StubClient:
+    def __init__(self, scheduler: ModelScheduler, delay: float = 0.05):
+        self.scheduler = scheduler
+        self.delay = delay
+        self.calls = []
+
+    def chat(self, model, messages, timeout=600, abort=None, on_reply=None):
+        with self.scheduler.slot(model, abort):
+            self.calls.append(model)
+            time.sleep(self.delay)
+            if on_reply is not None:
+                on_reply(f"{model} answer")
+            return f"{model} answer"
+
+
+def test_candidates_past_quorum_never_run(evicted):
+    s = scheduler(evicted, max_loaded=1)
+    client = StubClient(s)
+    candidates = generate_candidates(client, ["m1", "m2", "m3"], [{"role": "user", "content": "q"}], concurrency=3, quorum=2)
+    assert [c["status"] for c in candidates] == ["ok", "ok", "skipped"]
+    until(lambda: not s.stats()["waiting"] and not any(v["active"] for v in s.stats()["loaded"].values()))
+    assert client.calls == ["m1", "m2"]
+    assert s.loads == 2  # m3 was withdrawn, not loaded
+    # m2 waited for m1 to finish, which shows up as queue time rather than latency
+    assert candidates[1]["queued_ms"] >= 40 and candidates[1]["latency_ms"] < candidates[1]["queued_ms"] + 40